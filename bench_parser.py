@@ -0,0 +1,116 @@
+"""
+Замер трафика и времени загрузки страниц в обычном и облегченном профиле браузера.
+
+Запуск:
+    python bench_parser.py [URL или путь к сохраненной HTML-странице ...]
+    python bench_parser.py --startup
+
+Локальные файлы открываются через file://, поэтому сохраненные страницы
+Wildberries можно использовать как воспроизводимые фикстуры.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import parsermain
+from parsermain import create_driver
+
+DEFAULT_URLS = [
+    'https://www.wildberries.ru/catalog/0/search.aspx?search=%D1%82%D0%B5%D0%BB%D0%B5%D1%84%D0%BE%D0%BD',
+]
+RUNS = 3
+
+
+def to_url(target: str):
+    """
+    Преобразует путь к локальному файлу в file:// адрес.
+
+    Args:
+        target (str): URL или путь к файлу.
+
+    Returns:
+        url (str): Адрес для открытия в браузере.
+    """
+    if os.path.exists(target):
+        return 'file://' + os.path.abspath(target)
+    return target
+
+
+def measure_page_load(driver, url: str):
+    """
+    Открывает страницу и измеряет переданные байты и время готовности.
+
+    Args:
+        driver (webdriver.Chrome): Браузер с включенным журналом производительности.
+        url (str): Адрес страницы.
+
+    Returns:
+        result (Tuple[int, float]): Количество байтов, полученных по сети, и время до события load в миллисекундах.
+    """
+    driver.get_log('performance')
+    started = time.perf_counter()
+    driver.get(url)
+    wall_ms = (time.perf_counter() - started) * 1000
+    ready_ms = driver.execute_script(
+        "const t = performance.timing;"
+        "return t.loadEventEnd > 0 ? t.loadEventEnd - t.navigationStart : null;")
+
+    transferred = 0
+    for entry in driver.get_log('performance'):
+        message = json.loads(entry['message'])['message']
+        if message['method'] == 'Network.loadingFinished':
+            transferred += int(message['params'].get('encodedDataLength', 0))
+    return transferred, ready_ms if ready_ms is not None else wall_ms
+
+
+def measure_startup():
+    """
+    Печатает время импорта parsermain в новом процессе и стоимость
+    определения пути к chromedriver при первом и повторном вызове.
+    """
+    code = ("import sys, time; t = time.perf_counter(); import parsermain; "
+            "print((time.perf_counter() - t) * 1000, 'selenium' in sys.modules)")
+    runs = []
+    for _ in range(RUNS * 3):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        runs.append(float(output[0]))
+    print(f"import parsermain\t{statistics.median(runs):.0f} ms (медиана)\tselenium загружен: {output[1]}")
+
+    for attempt in ('первый', 'повторный'):
+        started = time.perf_counter()
+        try:
+            parsermain.resolve_chromedriver()
+        except Exception as e:
+            print(f"resolve_chromedriver: ошибка {e}")
+            return
+        print(f"resolve_chromedriver, {attempt} вызов\t{(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+def main():
+    """
+    Печатает средние трафик и время загрузки для каждого адреса в обоих профилях.
+    """
+    if '--startup' in sys.argv[1:]:
+        measure_startup()
+        return
+    urls = [to_url(target) for target in sys.argv[1:]] or DEFAULT_URLS
+    for lean in (False, True):
+        driver = create_driver(lean=lean, capture_traffic=True)
+        try:
+            driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled': True})
+            for url in urls:
+                results = [measure_page_load(driver, url) for _ in range(RUNS)]
+                transferred = sum(r[0] for r in results) / RUNS
+                ready_ms = sum(r[1] for r in results) / RUNS
+                print(f"{'lean' if lean else 'full'}\t{transferred / 1024:.1f} KiB\t{ready_ms:.0f} ms\t{url}")
+        finally:
+            driver.quit()
+
+
+if __name__ == '__main__':
+    main()
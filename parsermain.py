@@ -3,23 +3,80 @@ Telegram бот для парсинга товаров с Wildberries.
 """
 
 import asyncio
+import concurrent.futures
 import csv
 import random
 import glob
-from datetime import datetime
+import heapq
+import sys
+import gzip
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import CommandStart
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
+from aiohttp import web
 
 parsing_tasks = {}  # {user_id: asyncio.Task} - для управления задачами парсинга
+subscriptions = {}  # {user_id: {category: interval_minutes}} - категории пользователей
+subscription_events = {}  # {user_id: asyncio.Event} - пробуждение задачи при изменении подписок
+watchlists = {}  # {user_id: {article: target_price or None}} - списки отслеживания пользователей
+article_watchers = {}  # {article: {user_id: target_price or None}} - обратный индекс артикул -> наблюдатели
+watch_alerts = {}  # {(user_id, article): new_price} - последняя отправленная цена, чтобы не дублировать уведомления
+snapshot_cache = {}  # {user_id: OrderedDict{counter: rows}} - последние сохраненные снимки
+chromedriver_path = None  # путь к chromedriver, определяется один раз за время работы процесса
+product_catalog = {}  # {article: [name, rating, first_seen, last_seen]} - каталог товаров
+query_cache = OrderedDict()  # {(user_id, запрос, параметры...): результат} - LRU-кэш API
+query_generations = {}  # {user_id (str): int} - поколение данных пользователя, растет при каждой инвалидации
+catalog_loaded = False  # загружен ли каталог с диска
+catalog_lock = threading.Lock()  # загрузка каталога из нескольких потоков выполняется один раз
+catalog_log_size = 0  # строк в журнале изменений каталога с последнего сжатия
+
+WATCHLISTS_PATH = 'watchlists.csv'  # списки отслеживания: user_id, артикул, целевая цена
+KEEP_RECENT_SNAPSHOTS = 48  # сколько последних снимков хранится в полном разрешении
+COMPACTION_INTERVAL_MINUTES = 60  # периодичность фонового сжатия истории
+DAILY_HISTORY_AFTER_DAYS = 90  # история старше стольких дней от последнего снимка хранится по точке в день
+DUE_WINDOW_SECONDS = 30  # категории, срок которых наступает в этом окне, парсятся вместе с уже готовыми
+
+DEFAULT_SORT = 'popular'  # сортировка выдачи Wildberries по умолчанию
+SCRAPE_CACHE_TTL_SECONDS = 15*60  # время жизни страницы в кэше парсинга
+SCRAPE_CACHE_MAX_BYTES = 32*1024*1024  # размер кэша парсинга в памяти
+SCRAPE_CACHE_DIR = 'scrape_cache'  # каталог дискового уровня кэша парсинга
+
+FSYNC_POLICY = 'none'  # политика fsync при записи снимков: 'none', 'batch' или 'always'
+SNAPSHOT_CACHE_DEPTH = 2  # сколько последних снимков пользователя держать в памяти для сравнения
+CATALOG_PATH = 'catalog.csv'  # каталог товаров: артикул, название, рейтинг, впервые и последний раз замечен
+CATALOG_LOG_PATH = 'catalog_log.csv'  # журнал новых и измененных записей каталога с последнего сжатия
+
+CHROMEDRIVER_PATH = os.environ.get('CHROMEDRIVER_PATH')  # закрепленный путь к chromedriver для хостов без сети
+
+API_HOST = '127.0.0.1'  # адрес HTTP API только для чтения
+API_PORT = int(os.environ.get('API_PORT', 8080))  # порт HTTP API
+API_PAGE_SIZE = 100  # размер страницы ответа API по умолчанию
+API_MAX_PAGE_SIZE = 1000  # максимальный размер страницы ответа API
+API_STREAM_CHUNK = 500  # количество записей в одном фрагменте потокового ответа
+QUERY_CACHE_SIZE = 256  # количество результатов запросов в кэше API
+
+LEAN_PROFILE = True  # headless-браузер без картинок, медиа, шрифтов и аналитики
+LEAN_WINDOW_SIZE = '1280,800'  # размер окна в облегченном профиле
+BLOCKED_URL_PATTERNS = [  # запросы, блокируемые через Chrome DevTools Protocol
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico',
+    '*.mp4', '*.webm', '*.m3u8',
+    '*.woff', '*.woff2', '*.ttf', '*.otf',
+    '*google-analytics.com*', '*googletagmanager.com*', '*mc.yandex.ru*',
+    '*top-fwz1.mail.ru*', '*vk.com/rtrg*', '*ads.adfox.ru*',
+]
 
 
 def create_keyboards():
@@ -34,6 +91,7 @@ def create_keyboards():
             [KeyboardButton(text='Что делает этот бот')],
             [KeyboardButton(text='Добавить категорию')],
             [KeyboardButton(text='Вывести изменение цен')],
+            [KeyboardButton(text='Отслеживать артикулы')],
             [KeyboardButton(text='Остановить парсинг')]
         ], input_field_placeholder='Выберите пункт меню..')
         return main
@@ -64,172 +122,1681 @@ def the_cheapest(data: list):
         return None
 
 
-async def main_parser(category: str):
+def normalize_category(category: str):
+    """
+    Приводит название категории к единому виду для ключей кэша.
+
+    Args:
+        category (str): Название категории, введенное пользователем.
+
+    Returns:
+        normalized (str): Название в нижнем регистре с одиночными пробелами.
+    """
+    return ' '.join(category.lower().split())
+
+
+class ScrapeCache:
+    """
+    LRU-кэш результатов парсинга страниц с TTL и дисковым уровнем.
+
+    В памяти хранятся записи общим размером не более max_bytes, при
+    переполнении вытесняются давно не использованные. Каждая запись также
+    сохраняется на диск в cache_dir, поэтому вытесненные из памяти и
+    пережившие перезапуск страницы можно прочитать, пока не истек TTL.
+
+    Записи в памяти изменяются только из цикла событий. Дисковый уровень
+    (read_disk, write_disk, purge_disk) не трогает память и выполняется
+    в отдельном потоке, fetch и store объединяют оба уровня.
+
+    Attributes:
+        ttl_seconds (float): Время жизни записи в секундах.
+        max_bytes (int): Максимальный размер записей в памяти.
+        cache_dir (str or None): Каталог дискового уровня. Если None, диск не используется.
+    """
+
+    def __init__(self, ttl_seconds: float, max_bytes: int, cache_dir: str = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.size = 0
+        self._entries = OrderedDict()  # {key: (stored_at, size, value)}
+
+    def _disk_path(self, key: tuple):
+        digest = hashlib.sha1(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{digest}.json')
+
+    def _is_fresh(self, stored_at: float, max_age_seconds: float = None):
+        max_age = self.ttl_seconds if max_age_seconds is None else min(self.ttl_seconds, max_age_seconds)
+        return time.time() - stored_at <= max_age
+
+    def _put(self, key: tuple, stored_at: float, value, size: int):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (stored_at, size, value)
+        self.size += size
+        while self.size > self.max_bytes and self._entries:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def get(self, key: tuple, max_age_seconds: float = None):
+        """
+        Возвращает свежее значение из памяти.
+
+        Args:
+            key (tuple): Ключ (категория, страница, сортировка).
+            max_age_seconds (float or None): Дополнительное ограничение возраста записи.
+
+        Returns:
+            value (Any or None): Сохраненное значение или None, если записи нет или она устарела.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._is_fresh(entry[0], max_age_seconds):
+            self._entries.move_to_end(key)
+            return entry[2]
+        if not self._is_fresh(entry[0]):
+            self.size -= self._entries.pop(key)[1]
+        return None
+
+    def set(self, key: tuple, value):
+        """
+        Сохраняет значение в памяти.
+
+        Args:
+            key (tuple): Ключ (категория, страница, сортировка).
+            value (Any): JSON-сериализуемое значение.
+
+        Returns:
+            payload (str): JSON-запись для дискового уровня.
+        """
+        stored_at = time.time()
+        payload = json.dumps({'stored_at': stored_at, 'value': value}, ensure_ascii=False)
+        self._put(key, stored_at, value, len(payload.encode('utf-8')))
+        return payload
+
+    def read_disk(self, key: tuple, max_age_seconds: float = None):
+        """
+        Читает запись дискового уровня. Не трогает записи в памяти, поэтому
+        выполняется в отдельном потоке. Любая ошибка чтения считается промахом.
+
+        Args:
+            key (tuple): Ключ (категория, страница, сортировка).
+            max_age_seconds (float or None): Дополнительное ограничение возраста записи.
+
+        Returns:
+            record (Tuple[float, Any, int] or None): Время сохранения, значение и размер
+                  записи или None, если записи нет, она устарела или повреждена.
+        """
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                payload = f.read()
+            record = json.loads(payload)
+            stored_at, value = float(record['stored_at']), record['value']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not self._is_fresh(stored_at):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        if not self._is_fresh(stored_at, max_age_seconds):
+            return None
+        return stored_at, value, len(payload.encode('utf-8'))
+
+    def write_disk(self, key: tuple, payload: str):
+        """
+        Записывает запись дискового уровня. Выполняется в отдельном потоке.
+
+        Args:
+            key (tuple): Ключ (категория, страница, сортировка).
+            payload (str): JSON-запись, возвращенная set.
+
+        Returns:
+            None
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Запись через временный файл, чтобы purge_disk не прочитал недописанный файл
+            path = self._disk_path(key)
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            print(f"Ошибка записи кэша парсинга на диск: {e}")
+
+    async def fetch(self, key: tuple, max_age_seconds: float = None):
+        """
+        Возвращает свежее значение из памяти или, при промахе, с диска.
+        Диск читается в отдельном потоке, найденная запись поднимается в память.
+
+        Args:
+            key (tuple): Ключ (категория, страница, сортировка).
+            max_age_seconds (float or None): Дополнительное ограничение возраста записи.
+
+        Returns:
+            value (Any or None): Сохраненное значение или None, если записи нет или она устарела.
+        """
+        value = self.get(key, max_age_seconds)
+        if value is not None or self.cache_dir is None:
+            return value
+        record = await asyncio.to_thread(self.read_disk, key, max_age_seconds)
+        if record is None:
+            return None
+        self._put(key, record[0], record[1], record[2])
+        return record[1]
+
+    async def store(self, key: tuple, value):
+        """
+        Сохраняет значение в памяти и, в отдельном потоке, на диске.
+
+        Args:
+            key (tuple): Ключ (категория, страница, сортировка).
+            value (Any): JSON-сериализуемое значение.
+
+        Returns:
+            None
+        """
+        payload = self.set(key, value)
+        if self.cache_dir is not None:
+            await asyncio.to_thread(self.write_disk, key, payload)
+
+    def purge_expired(self):
+        """
+        Удаляет устаревшие записи из памяти.
+
+        Returns:
+            removed (int): Количество удаленных записей.
+        """
+        expired = [key for key, entry in self._entries.items() if not self._is_fresh(entry[0])]
+        for key in expired:
+            self.size -= self._entries.pop(key)[1]
+        return len(expired)
+
+    def purge_disk(self):
+        """
+        Удаляет устаревшие файлы дискового уровня. Не трогает записи в памяти,
+        поэтому может выполняться в отдельном потоке.
+
+        Returns:
+            removed (int): Количество удаленных файлов.
+        """
+        removed = 0
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return removed
+        for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    stored_at = json.load(f)['stored_at']
+                if self._is_fresh(stored_at):
+                    continue
+            except (OSError, ValueError, KeyError):
+                pass
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+scrape_cache = ScrapeCache(SCRAPE_CACHE_TTL_SECONDS, SCRAPE_CACHE_MAX_BYTES, SCRAPE_CACHE_DIR)
+"""Кэш страниц выдачи, общий для всех пользователей и повторных попыток."""
+
+
+def add_to_watchlist(user_id: int, article: str, target_price: int = None):
+    """
+    Добавляет артикул в список отслеживания пользователя и в обратный индекс.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        article (str): Артикул товара.
+        target_price (int or None): Целевая цена. Если None, уведомление приходит при любом снижении цены.
+
+    Returns:
+        None: Функция не возвращает значения, только обновляет watchlists и article_watchers.
+    """
+    article = str(article).strip()
+    watchlists.setdefault(user_id, {})[article] = target_price
+    article_watchers.setdefault(article, {})[user_id] = target_price
+
+
+def remove_from_watchlist(user_id: int, article: str):
+    """
+    Удаляет артикул из списка отслеживания пользователя и из обратного индекса.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        article (str): Артикул товара.
+
+    Returns:
+        removed (bool): True, если артикул был в списке отслеживания, иначе False.
+    """
+    article = str(article).strip()
+    user_watchlist = watchlists.get(user_id, {})
+    if article not in user_watchlist:
+        return False
+    del user_watchlist[article]
+    if not user_watchlist:
+        del watchlists[user_id]
+    watchers = article_watchers.get(article, {})
+    watchers.pop(user_id, None)
+    if not watchers:
+        article_watchers.pop(article, None)
+    watch_alerts.pop((user_id, article), None)
+    return True
+
+
+def watchlist_rows():
+    """
+    Формирует строки списков отслеживания для записи на диск.
+
+    Returns:
+        rows (List[List[Union[int, str]]]): Строки [user_id, артикул, целевая цена или ''].
+    """
+    return [[user_id, article, '' if target_price is None else target_price]
+            for user_id, user_watchlist in watchlists.items()
+            for article, target_price in user_watchlist.items()]
+
+
+def save_watchlists(rows: list, fsync: bool = False):
+    """
+    Атомарно записывает списки отслеживания в WATCHLISTS_PATH.
+
+    Args:
+        rows (List[List[Union[int, str]]]): Строки [user_id, артикул, целевая цена или ''].
+        fsync (bool): Сбросить содержимое файла на диск перед переименованием.
+
+    Returns:
+        None
+    """
+    write_csv_atomic(WATCHLISTS_PATH, rows, fsync)
+
+
+def load_watchlists():
+    """
+    Загружает списки отслеживания из WATCHLISTS_PATH и перестраивает обратный индекс.
+
+    Returns:
+        None: Функция не возвращает значения, только заполняет watchlists и article_watchers.
+    """
+    try:
+        rows = read_csv_rows(WATCHLISTS_PATH)
+    except FileNotFoundError:
+        return
+    for row in rows:
+        try:
+            add_to_watchlist(int(row[0]), row[1], int(row[2]) if row[2] else None)
+        except (ValueError, IndexError):
+            print(f"Пропущена некорректная строка списка отслеживания: {row}")
+
+
+def check_watchlists(changes: list):
+    """
+    Проверяет правила отслеживания только для изменившихся артикулов.
+    Наблюдатели ищутся через обратный индекс, поэтому стоимость проверки
+    зависит от количества изменений, а не от размера списков отслеживания.
+    Если артикул встречается в нескольких категориях или подписках, уведомление
+    о той же цене отправляется наблюдателю только один раз (см. watch_alerts).
+
+    Args:
+        changes (List[Tuple[str, int or None, int]]): Список изменений [(артикул, старая цена, новая цена)].
+            Для новых товаров старая цена равна None.
+
+    Returns:
+        alerts (List[Tuple[int, str]]): Список уведомлений [(user_id, текст сообщения)].
+    """
+    alerts = []
+    for article, old_price, new_price in changes:
+        watchers = article_watchers.get(str(article))
+        if not watchers:
+            continue
+        for user_id, target_price in watchers.items():
+            key = (user_id, str(article))
+            if target_price is None:
+                fired = old_price is not None and new_price < old_price
+                text = f'Цена товара {article} снизилась: {old_price} -> {new_price} руб.'
+            else:
+                fired = new_price <= target_price and (old_price is None or old_price > target_price)
+                text = f'Цена товара {article} достигла цели {target_price} руб.: сейчас {new_price} руб.'
+            if not fired:
+                if watch_alerts.get(key) != new_price:
+                    watch_alerts.pop(key, None)
+                continue
+            if watch_alerts.get(key) == new_price:
+                continue
+            watch_alerts[key] = new_price
+            alerts.append((user_id, text))
+    return alerts
+
+
+async def main_parser(category: str, sort: str = DEFAULT_SORT, max_age_seconds: float = None,
+                      session: 'BrowserSession' = None):
     """
     Основная функция парсинга товаров с маркетплейса Wildberries.
 
+    Результат каждой страницы кэшируется в scrape_cache по ключу
+    (нормализованная категория, страница, сортировка). Пустые страницы и
+    страницы, сбор которых прервался ошибкой, не кэшируются. Свежие страницы
+    из кэша не загружаются повторно, а если в кэше есть все страницы,
+    браузер не запускается вовсе.
+
+    Args:
+        category (str): Название категории товаров для поиска на Wildberries.
+        sort (str): Сортировка выдачи Wildberries.
+        max_age_seconds (float or None): Максимальный возраст страниц из кэша в секундах.
+            Если None, используется TTL кэша.
+        session (BrowserSession or None): Общая браузерная сессия. Если None, создается
+            собственная сессия, которая закрывается по окончании парсинга.
+
+    Returns:
+        list (List[List[Union[int, str]]]): Список списков с данными о товарах. Каждый внутренний список содержит:
+              [артикул (int), цена (int), название (str), рейтинг (str)]
+
+    Raises:
+        Exception: При возникновении любых ошибок парсинга.
+    """
+    try:
+        from selenium.webdriver.common.by import By
+
+        normalized = normalize_category(category)
+        collected_data = []
+        own_session = session is None
+        if own_session:
+            session = BrowserSession()
+        search_url = None
+        page = 1
+
+        try:
+            while True:
+                key = (normalized, page, sort)
+                cached = await scrape_cache.fetch(key, max_age_seconds)
+                if cached is None:
+                    driver = await session.get_driver()
+                    if search_url is None:
+                        search_url = await open_search(driver, category)
+                    driver.get(page_url(search_url, page, sort))
+                    await asyncio.sleep(1)
+                    rows, complete = await scrape_page(driver)
+                    has_next = bool(driver.find_elements(By.CLASS_NAME, "pagination-next"))
+                    cached = {'rows': rows, 'last': not rows or not has_next}
+                    # Пустая или прерванная ошибкой страница может быть временным сбоем
+                    if rows and complete:
+                        await scrape_cache.store(key, cached)
+
+                collected_data.extend(cached['rows'])
+                if cached['last']:
+                    break
+                page += 1
+        except Exception as e:
+            print(f"Ошибка при парсинге страницы: {e}")
+            # Браузер мог остаться в неизвестном состоянии, следующей категории нужен новый
+            session.close()
+            raise
+        finally:
+            if own_session:
+                session.close()
+
+        return collected_data
+    except Exception as e:
+        print(f"Общая ошибка в main_parser: {e}")
+        raise
+
+
+def resolve_chromedriver():
+    """
+    Определяет путь к chromedriver. Результат запоминается, поэтому разрешение
+    версии через webdriver_manager выполняется один раз за время работы процесса.
+    Если задан CHROMEDRIVER_PATH, используется он и сеть не требуется.
+
+    Returns:
+        path (str): Путь к исполняемому файлу chromedriver.
+
+    Raises:
+        FileNotFoundError: Если файл по пути CHROMEDRIVER_PATH не существует.
+    """
+    global chromedriver_path
+    if chromedriver_path is None:
+        if CHROMEDRIVER_PATH:
+            if not os.path.isfile(CHROMEDRIVER_PATH):
+                raise FileNotFoundError(f"chromedriver не найден: {CHROMEDRIVER_PATH}")
+            chromedriver_path = CHROMEDRIVER_PATH
+        else:
+            from webdriver_manager.chrome import ChromeDriverManager
+            chromedriver_path = ChromeDriverManager().install()
+    return chromedriver_path
+
+
+def create_driver(lean: bool = LEAN_PROFILE, blocked_patterns: list = None, capture_traffic: bool = False):
+    """
+    Запускает Chrome с настройками, скрывающими автоматизацию.
+
+    В облегченном профиле браузер работает в headless-режиме без GPU,
+    с уменьшенным окном, а картинки, медиа, шрифты и аналитика блокируются
+    через Chrome DevTools Protocol, так как из карточек читается только текст.
+
+    Args:
+        lean (bool): Использовать облегченный профиль.
+        blocked_patterns (List[str] or None): Шаблоны блокируемых адресов. Если None, используется BLOCKED_URL_PATTERNS.
+        capture_traffic (bool): Включить журнал производительности для подсчета переданных байтов.
+
+    Returns:
+        driver (webdriver.Chrome): Экземпляр браузера.
+    """
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service as ChromeService
+
+    user_agents = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
+    ]
+    options = Options()
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_experimental_option(
+        "excludeSwitches", ["enable-automation"])
+    options.add_experimental_option('useAutomationExtension', False)
+    options.add_argument(f"--user-agent={random.choice(user_agents)}")
+    if lean:
+        options.add_argument("--headless=new")
+        options.add_argument("--disable-gpu")
+        options.add_argument(f"--window-size={LEAN_WINDOW_SIZE}")
+        options.add_argument("--blink-settings=imagesEnabled=false")
+    if capture_traffic:
+        options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    driver = webdriver.Chrome(options=options, service=ChromeService(
+        resolve_chromedriver()))
+    if lean:
+        block_requests(driver, BLOCKED_URL_PATTERNS if blocked_patterns is None else blocked_patterns)
+    return driver
+
+
+def block_requests(driver, patterns: list):
+    """
+    Блокирует загрузку ресурсов по шаблонам адресов через Chrome DevTools Protocol.
+
+    Args:
+        driver (webdriver.Chrome): Экземпляр браузера.
+        patterns (List[str]): Шаблоны адресов, '*' соответствует любой подстроке.
+
+    Returns:
+        None
+    """
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': patterns})
+
+
+class BrowserSession:
+    """
+    Браузерная сессия, общая для нескольких категорий одного окна планирования.
+
+    Браузер запускается при первом обращении и один раз открывает главную
+    страницу Wildberries. Последующие категории используют уже полученные
+    cookies и загруженные ресурсы.
+
+    Attributes:
+        driver (webdriver.Chrome or None): Экземпляр браузера или None, если он еще не запущен.
+    """
+
+    def __init__(self):
+        self.driver = None
+
+    async def get_driver(self):
+        """
+        Возвращает браузер сессии, при необходимости запуская его.
+
+        Returns:
+            driver (webdriver.Chrome): Экземпляр браузера с открытой главной страницей.
+        """
+        if self.driver is None:
+            self.driver = create_driver()
+            self.driver.get('https://www.wildberries.ru')
+            await asyncio.sleep(5)
+        return self.driver
+
+    def close(self):
+        """
+        Закрывает браузер сессии, если он был запущен.
+
+        Returns:
+            None
+        """
+        if self.driver is not None:
+            try:
+                self.driver.close()
+            except:
+                pass
+            self.driver = None
+
+
+async def parse_categories(categories: list, max_age_seconds: float = None):
+    """
+    Парсит несколько категорий подряд в одной браузерной сессии.
+
+    Args:
+        categories (List[str]): Категории товаров.
+        max_age_seconds (float or None): Максимальный возраст страниц из кэша в секундах.
+
+    Returns:
+        results (Dict[str, Union[list, Exception]]): Для каждой категории список товаров
+              [артикул (int), цена (int), название (str), рейтинг (str)] или исключение, если парсинг не удался.
+    """
+    results = {}
+    session = BrowserSession()
+    try:
+        for category in categories:
+            try:
+                results[category] = await main_parser(
+                    category, max_age_seconds=max_age_seconds, session=session)
+            except Exception as e:
+                results[category] = e
+    finally:
+        session.close()
+    return results
+
+
+async def open_search(driver, category: str):
+    """
+    Выполняет поиск по категории из строки поиска на текущей странице Wildberries.
+
+    Args:
+        driver (webdriver.Chrome): Экземпляр браузера.
+        category (str): Название категории товаров.
+
+    Returns:
+        search_url (str): Адрес страницы результатов поиска.
+    """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+
+    elem = driver.find_element(By.ID, "searchInput")
+    elem.clear()
+    await asyncio.sleep(1)
+    elem.send_keys(category)
+    elem.send_keys(Keys.RETURN)
+    await asyncio.sleep(5)
+    return driver.current_url
+
+
+def page_url(search_url: str, page: int, sort: str):
+    """
+    Формирует адрес конкретной страницы выдачи с заданной сортировкой.
+
+    Args:
+        search_url (str): Адрес страницы результатов поиска.
+        page (int): Номер страницы, начиная с 1.
+        sort (str): Сортировка выдачи.
+
+    Returns:
+        url (str): Адрес страницы.
+    """
+    parts = urlsplit(search_url)
+    query = dict(parse_qsl(parts.query))
+    query['page'] = str(page)
+    query['sort'] = sort
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+async def scrape_page(driver):
+    """
+    Собирает карточки товаров с открытой страницы выдачи, прокручивая ее.
+
+    Args:
+        driver (webdriver.Chrome): Экземпляр браузера с открытой страницей выдачи.
+
+    Returns:
+        result (Tuple[List[List[Union[int, str]]], bool]): Товары страницы [артикул (int), цена (int),
+              название (str), рейтинг (str)] и признак того, что сбор дошел до конца карточек,
+              а не прервался ошибкой.
+    """
+    from selenium.common.exceptions import NoSuchElementException
+    from selenium.webdriver.common.by import By
+
+    page_data = []
+    i = 0
+    await asyncio.sleep(0.3)
+    cards_page_good = 1
+    complete = True
+
+    while cards_page_good:
+        await asyncio.sleep(0.1)
+        try:
+            element = driver.find_element(
+                By.CSS_SELECTOR, f'article[data-card-index="{i}"]')
+            driver.execute_script(
+                "arguments[0].scrollIntoView();", element)
+
+            for _ in range(14):
+                try:
+                    content = driver.find_element(
+                        By.CSS_SELECTOR, f'article[data-card-index="{i}"]')
+                    id = int(content.get_attribute("id")[1:])
+                    price = int(content.find_element(
+                        By.CLASS_NAME, 'price__lower-price').text[:-2].replace(' ', ''))
+                    name = content.find_element(
+                        By.CLASS_NAME, f'product-card__name').text
+
+                    try:
+                        grade = content.find_element(
+                            By.CLASS_NAME, f'address-rate-mini').text
+                    except Exception:
+                        grade = '0'
+
+                    page_data.append([id, price, name, grade])
+                    i += 1
+                except NoSuchElementException:
+                    cards_page_good = 0
+                    break
+            await asyncio.sleep(0.2)
+        except NoSuchElementException:
+            cards_page_good = 0
+        except Exception as e:
+            print(f"Сбор карточек прерван на карточке {i}: {e}")
+            cards_page_good = 0
+            complete = False
+    return page_data, complete
+
+
+def sorted_data(collected_data: list):
+    """
+    Сортирует по артикулу и убирает дубликаты в списке.
+
+    Args:
+        collected_data (List[List[Union[int, str]]]): Список списков с данными о товарах. Каждый внутренний элемент содержит:
+              [артикул (int), цена (int), название (str), рейтинг (str)]
+
+    Returns:
+        collected_data (List[List[Union[int, str]]]): Первоначальный список, отсортированный по возрастанию первого элемента(артикула).
+              В списке отсутствуют дублирующие строчки.
+              Каждый внутренний список содержит: [артикул (int), цена (int), название (str), рейтинг (str)]
+
+    Raises:
+        Exception: Ошибки при сортировке.
+    """
+    try:
+        collected_data = sorted(collected_data, key=lambda x: x[0])
+        i = 0
+        while i < len(collected_data):
+            j = i + 1
+            while j < len(collected_data):
+                if collected_data[i][0] == collected_data[j][0]:
+                    collected_data.pop(j)
+                else:
+                    j += 1
+            i += 1
+        return collected_data
+    except Exception as e:
+        print(f"Ошибка в сортировке файла: {e}")
+        raise
+
+def save_to_csv(data: list, counter: int, user_id: int, category: str = None, fsync: bool = False):
+    """
+    Сохраняет цены из данных парсинга в CSV файл с добавлением временной метки.
+    В снимок попадают только строки [артикул, цена], названия и рейтинги
+    хранятся в каталоге товаров (см. update_catalog). Данные пишутся во
+    временный файл, который затем атомарно переименовывается, поэтому при
+    сбое посреди записи предыдущее содержимое файла не повреждается.
+
+    Args:
+        data (List[List[Union[int, str]]]): Список списков с данными о товарах [артикул (int), цена (int), название (str), рейтинг(str)]
+        counter (int): Порядковый номер файла.
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров. Если None, используется общий для пользователя файл.
+        fsync (bool): Сбросить содержимое файла на диск перед переименованием.
+
+    Raises:
+        Exception: При возникновении любых ошибок ввода-вывода или обработки данных.
+
+    Returns:
+        None: Функция не возвращает значения, только создает файл.
+    """
+    try:
+        data.append([datetime.now().strftime('%d.%m.%Y %H:%M:%S')])
+        filename = snapshot_path(user_id, counter, category)
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            for element_id in data:
+                writer.writerow(element_id[:2])
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_filename, filename)
+    except Exception as e:
+        print(f"Ошибка сохранения в CSV для пользователя {user_id}: {e}")
+        raise
+
+
+def write_csv_atomic(filename: str, rows: list, fsync: bool = False):
+    """
+    Записывает строки в CSV файл через временный файл и атомарное переименование.
+
+    Args:
+        filename (str): Путь к файлу.
+        rows (List[list]): Строки для записи.
+        fsync (bool): Сбросить содержимое файла на диск перед переименованием.
+
+    Returns:
+        None
+    """
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerows(rows)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def fsync_directory(path: str = '.'):
+    """
+    Сбрасывает на диск запись каталога, чтобы переименование файла пережило сбой питания.
+
+    Args:
+        path (str): Путь к каталогу.
+
+    Returns:
+        None
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class SnapshotWriter:
+    """
+    Фоновый поток записи снимков.
+
+    Задания из очереди обрабатываются пачками: поток забирает все накопившиеся
+    задания и выполняет их подряд. Политика fsync:
+    'none' - без fsync, 'batch' - fsync каждого файла и один fsync каталога
+    на пачку, 'always' - fsync файла и каталога после каждой записи.
+
+    Attributes:
+        fsync_policy (str): Политика сброса данных на диск.
+        max_batch (int): Максимальное количество заданий в пачке.
+    """
+
+    def __init__(self, fsync_policy: str = 'none', max_batch: int = 32):
+        if fsync_policy not in ('none', 'batch', 'always'):
+            raise ValueError(f"Неизвестная политика fsync: {fsync_policy}")
+        self.fsync_policy = fsync_policy
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='snapshot-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            batch = [job]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+
+            for future, func, args in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = func(*args, fsync=self.fsync_policy != 'none')
+                    if self.fsync_policy == 'always':
+                        fsync_directory()
+                    future.set_result(result)
+                except Exception as e:
+                    future.set_exception(e)
+            if self.fsync_policy == 'batch':
+                fsync_directory()
+            if stop:
+                return
+
+    def submit(self, func, *args):
+        """
+        Ставит функцию записи в очередь фонового потока.
+
+        Args:
+            func (Callable): Функция записи, принимающая именованный аргумент fsync.
+            *args: Позиционные аргументы функции.
+
+        Returns:
+            future (concurrent.futures.Future): Результат выполнения записи.
+        """
+        future = concurrent.futures.Future()
+        self._ensure_started()
+        self._queue.put((future, func, args))
+        return future
+
+    def close(self):
+        """
+        Дожидается выполнения поставленных заданий и останавливает поток.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+
+snapshot_writer = SnapshotWriter(FSYNC_POLICY)
+"""Фоновый поток записи снимков."""
+
+
+def remember_snapshot(user_id: int, counter: int, rows: list, category: str = None):
+    """
+    Кладет снимок в кэш последних снимков пользователя по категории.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        counter (int): Порядковый номер снимка.
+        rows (List[List[str]]): Строки снимка в том виде, в котором они читаются из CSV.
+        category (str or None): Категория товаров.
+
+    Returns:
+        None
+    """
+    user_cache = snapshot_cache.setdefault(stream_name(user_id, category), OrderedDict())
+    user_cache[counter] = rows
+    user_cache.move_to_end(counter)
+    while len(user_cache) > SNAPSHOT_CACHE_DEPTH:
+        user_cache.popitem(last=False)
+
+
+async def save_snapshot(data: list, counter: int, user_id: int, category: str = None):
+    """
+    Асинхронно сохраняет снимок через фоновый поток записи и обновляет кэш.
+    Новые товары и записи каталога с измененными названиями или рейтингами
+    дописываются в журнал каталога, сам каталог не переписывается.
+
+    Args:
+        data (List[List[Union[int, str]]]): Список списков с данными о товарах [артикул (int), цена (int), название (str), рейтинг(str)]
+        counter (int): Порядковый номер файла.
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
+
+    Raises:
+        Exception: Ошибки записи файла.
+
+    Returns:
+        None
+    """
+    global catalog_log_size
+    if not catalog_loaded:
+        await asyncio.to_thread(load_catalog)
+    catalog_future = None
+    changed = update_catalog(data, datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+    if changed:
+        catalog_future = snapshot_writer.submit(append_catalog_log, changed)
+        catalog_log_size += len(changed)
+    await asyncio.wrap_future(snapshot_writer.submit(save_to_csv, data, counter, user_id, category))
+    if catalog_future is not None:
+        await asyncio.wrap_future(catalog_future)
+    remember_snapshot(user_id, counter, [[str(value) for value in row] for row in data], category)
+    invalidate_queries(user_id)
+
+
+def read_csv_rows(filename: str):
+    """
+    Читает все строки CSV файла.
+
+    Args:
+        filename (str): Путь к файлу.
+
+    Returns:
+        rows (List[List[str]]): Строки файла.
+
+    Raises:
+        FileNotFoundError: Если файл не существует.
+    """
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+
+def load_catalog():
+    """
+    Загружает каталог товаров из CATALOG_PATH и применяет к нему журнал
+    изменений CATALOG_LOG_PATH при первом обращении. Вызывается из потоков
+    API и записи, поэтому загрузка выполняется под catalog_lock.
+
+    Returns:
+        None: Функция не возвращает значения, только заполняет product_catalog.
+    """
+    global catalog_loaded, catalog_log_size
+    if catalog_loaded:
+        return
+    with catalog_lock:
+        if catalog_loaded:
+            return
+        for path in (CATALOG_PATH, CATALOG_LOG_PATH):
+            try:
+                rows = read_csv_rows(path)
+            except FileNotFoundError:
+                continue
+            for row in rows:
+                # Строка журнала, оборванная сбоем посреди записи, короче пяти полей
+                if len(row) == 5:
+                    product_catalog[row[0]] = [sys.intern(row[1]), row[2], row[3], row[4]]
+            if path == CATALOG_LOG_PATH:
+                catalog_log_size = len(rows)
+        catalog_loaded = True
+
+
+def update_catalog(data: list, timestamp: str):
+    """
+    Обновляет каталог товаров по данным парсинга.
+
+    Args:
+        data (List[List[Union[int, str]]]): Список списков с данными о товарах [артикул (int), цена (int), название (str), рейтинг (str)]
+        timestamp (str): Время парсинга в формате '%d.%m.%Y %H:%M:%S'.
+
+    Returns:
+        changed (List[List[str]]): Строки каталога новых товаров и товаров с измененными названиями
+              или рейтингами, которые нужно дописать в журнал. Пустой список, если таких нет.
+    """
+    changed = []
+    for row in data:
+        if len(row) < 4:
+            continue
+        article, name, rating = str(row[0]), str(row[2]), str(row[3])
+        entry = product_catalog.get(article)
+        if entry is None:
+            entry = product_catalog[article] = [sys.intern(name), rating, timestamp, timestamp]
+            changed.append([article] + entry)
+            continue
+        entry[3] = timestamp
+        if entry[0] != name or entry[1] != rating:
+            entry[0] = sys.intern(name)
+            entry[1] = rating
+            changed.append([article] + entry)
+    return changed
+
+
+def catalog_rows():
+    """
+    Формирует строки каталога товаров для записи на диск.
+
+    Returns:
+        rows (List[List[str]]): Строки [артикул, название, рейтинг, впервые замечен, последний раз замечен].
+    """
+    return [[article] + entry for article, entry in product_catalog.items()]
+
+
+def append_catalog_log(rows: list, fsync: bool = False):
+    """
+    Дописывает новые и измененные записи каталога в журнал CATALOG_LOG_PATH.
+
+    Args:
+        rows (List[List[str]]): Строки каталога [артикул, название, рейтинг, впервые замечен, последний раз замечен].
+        fsync (bool): Сбросить содержимое файла на диск после записи.
+
+    Returns:
+        None
+    """
+    with open(CATALOG_LOG_PATH, 'a', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows(rows)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def save_catalog(rows: list, fsync: bool = False):
+    """
+    Сжимает журнал каталога: атомарно записывает полный каталог в CATALOG_PATH
+    и удаляет журнал, все записи которого вошли в каталог.
+
+    Выполняется в потоке записи snapshot_writer после всех ранее поставленных
+    дописываний журнала, поэтому rows уже содержат их изменения.
+
+    Args:
+        rows (List[List[str]]): Строки каталога [артикул, название, рейтинг, впервые замечен, последний раз замечен].
+        fsync (bool): Сбросить содержимое файла на диск перед переименованием.
+
+    Returns:
+        None
+    """
+    write_csv_atomic(CATALOG_PATH, rows, fsync)
+    try:
+        os.remove(CATALOG_LOG_PATH)
+    except FileNotFoundError:
+        pass
+
+
+def compact_catalog():
+    """
+    Ставит сжатие журнала каталога в очередь записи, если журнал не пуст.
+
+    Returns:
+        future (concurrent.futures.Future or None): Задача записи или None, если сжимать нечего.
+    """
+    global catalog_log_size
+    if not catalog_loaded or not catalog_log_size:
+        return None
+    catalog_log_size = 0
+    return snapshot_writer.submit(save_catalog, catalog_rows())
+
+
+def expand_rows(rows: list):
+    """
+    Восстанавливает полный снимок, подставляя названия и рейтинги из каталога.
+
+    Args:
+        rows (List[List[str]]): Строки снимка [артикул, цена] и временная метка последней строкой.
+            Строки старого формата [артикул, цена, название, рейтинг] возвращаются без изменений.
+
+    Returns:
+        rows (List[List[str]]): Строки [артикул, цена, название, рейтинг] и временная метка.
+    """
+    expanded = []
+    for row in rows:
+        if len(row) == 2:
+            entry = product_catalog.get(row[0])
+            if entry is not None:
+                row = [row[0], row[1], entry[0], entry[1]]
+            else:
+                row = [row[0], row[1], '', '0']
+        expanded.append(row)
+    return expanded
+
+
+def read_snapshot(filename: str):
+    """
+    Читает снимок с диска и восстанавливает его полный вид по каталогу.
+
+    Args:
+        filename (str): Путь к файлу снимка.
+
+    Returns:
+        rows (List[List[str]]): Строки [артикул, цена, название, рейтинг] и временная метка.
+
+    Raises:
+        FileNotFoundError: Если файл не существует.
+    """
+    load_catalog()
+    return expand_rows(read_csv_rows(filename))
+
+
+async def load_snapshot(user_id: int, counter: int, category: str = None):
+    """
+    Асинхронно загружает снимок, сначала из кэша, затем с диска в отдельном потоке.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        counter (int): Порядковый номер снимка.
+        category (str or None): Категория товаров.
+
+    Returns:
+        rows (List[List[str]]): Строки снимка, последняя строка - временная метка.
+
+    Raises:
+        FileNotFoundError: Если снимок не найден.
+    """
+    rows = snapshot_cache.get(stream_name(user_id, category), {}).get(counter)
+    if rows is not None:
+        return rows
+    return await asyncio.to_thread(read_snapshot, snapshot_path(user_id, counter, category))
+
+
+def category_key(category: str):
+    """
+    Преобразует название категории в ключ для имен файлов: нормализованное
+    название, в котором все символы, кроме букв и цифр, заменены на '-'.
+
+    Args:
+        category (str): Название категории или уже готовый ключ.
+
+    Returns:
+        key (str): Ключ категории без символов '_'.
+    """
+    return ''.join(ch if ch.isalnum() else '-' for ch in normalize_category(category))
+
+
+def stream_name(user_id: int, category: str = None):
+    """
+    Формирует имя потока снимков для пары (пользователь, категория).
+
     Args:
-        category (str): Название категории товаров для поиска на Wildberries.
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров. Если None, используется общий поток пользователя.
 
     Returns:
-        list (List[List[Union[int, str]]]): Список списков с данными о товарах. Каждый внутренний список содержит:
-              [артикул (int), цена (int), название (str), рейтинг (str)]
+        name (str): '{user_id}' или '{user_id}_{ключ категории}'.
+    """
+    if category is None:
+        return f'{user_id}'
+    return f'{user_id}_{category_key(category)}'
 
-    Raises:
-        Exception: При возникновении любых ошибок парсинга.
+
+def snapshot_path(user_id: int, counter: int, category: str = None):
+    """
+    Формирует имя файла снимка elements_{user_id}[_{категория}]_{counter}.csv.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        counter (int): Порядковый номер снимка.
+        category (str or None): Категория товаров.
+
+    Returns:
+        filename (str): Имя файла снимка.
+    """
+    return f'elements_{stream_name(user_id, category)}_{counter}.csv'
+
+
+def segment_path(user_id: int, category: str = None, month: str = None, daily: bool = False):
+    """
+    Формирует имя сжатого сегмента истории history_{user_id}[_{категория}].{ГГГГ-ММ}[.daily].csv.gz.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
+        month (str or None): Месяц сегмента 'ГГГГ-ММ'. Если None, возвращается имя
+            единого сегмента прежнего формата history_{user_id}[_{категория}].csv.gz.
+        daily (bool): Сегмент, прореженный до одной точки в день.
+
+    Returns:
+        filename (str): Имя файла сегмента.
+    """
+    name = f'history_{stream_name(user_id, category)}'
+    if month is None:
+        return f'{name}.csv.gz'
+    return f'{name}.{month}.daily.csv.gz' if daily else f'{name}.{month}.csv.gz'
+
+
+def history_state_path(user_id: int, category: str = None):
+    """
+    Формирует имя файла последних цен, записанных в сегменты истории.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
+
+    Returns:
+        filename (str): Имя файла состояния.
+    """
+    return f'history_{stream_name(user_id, category)}.state.csv'
+
+
+def history_month(timestamp: str):
+    """
+    Возвращает месяц временной метки '%d.%m.%Y %H:%M:%S' в виде 'ГГГГ-ММ'.
+    """
+    return f'{timestamp[6:10]}-{timestamp[3:5]}'
+
+
+def sortable_timestamp(timestamp: str):
+    """
+    Преобразует временную метку '%d.%m.%Y %H:%M:%S' в строку, которая сравнивается
+    в хронологическом порядке.
+    """
+    return timestamp[6:10] + timestamp[3:5] + timestamp[:2] + timestamp[10:]
+
+
+def list_segments(user_id: int, category: str = None):
     """
+    Находит помесячные сегменты истории пользователя.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
+
+    Returns:
+        segments (List[Tuple[str, str]]): Пары (месяц 'ГГГГ-ММ', путь) по возрастанию месяца.
+              Если для месяца остались оба сегмента (сбой во время прореживания), берется прореженный.
+    """
+    prefix = f'history_{stream_name(user_id, category)}.'
+    segments = {}
+    for path in glob.glob(glob.escape(prefix) + '*.csv.gz'):
+        parts = path[len(prefix):-len('.csv.gz')].split('.')
+        if len(parts) == 2 and parts[1] == 'daily':
+            segments[parts[0]] = path
+        elif len(parts) == 1:
+            segments.setdefault(parts[0], path)
+    return sorted(segments.items())
+
+
+def parse_snapshot_name(file_path: str):
+    """
+    Разбирает имя файла снимка.
+
+    Args:
+        file_path (str): Путь к файлу снимка.
+
+    Returns:
+        parsed (Tuple[str, str or None, int] or None): (user_id, ключ категории, номер) или None,
+              если имя не соответствует шаблону. Для общего потока пользователя ключ равен None.
+    """
+    name = os.path.basename(file_path)
+    if not name.startswith('elements_') or not name.endswith('.csv'):
+        return None
+    parts = name[len('elements_'):-len('.csv')].split('_')
     try:
-        user_agents = [
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
-        ]
-        options = Options()
-        options.add_argument("--disable-blink-features=AutomationControlled")
-        options.add_experimental_option(
-            "excludeSwitches", ["enable-automation"])
-        options.add_experimental_option('useAutomationExtension', False)
-        options.add_argument(f"--user-agent={random.choice(user_agents)}")
-        driver = webdriver.Chrome(options=options, service=ChromeService(
-            ChromeDriverManager().install()))
+        if len(parts) == 2:
+            return parts[0], None, int(parts[1])
+        if len(parts) == 3:
+            return parts[0], parts[1], int(parts[2])
+    except ValueError:
+        pass
+    return None
 
-        try:
-            main_url = 'https://www.wildberries.ru'
-            driver.get(main_url)
-            await asyncio.sleep(5)
-            elem = driver.find_element(By.ID, "searchInput")
-            elem.clear()
-            staff_name = category
-            await asyncio.sleep(1)
-            elem.send_keys(staff_name)
-            elem.send_keys(Keys.RETURN)
-            await asyncio.sleep(5)
-            urlpage = driver.current_url
-            driver.get(urlpage)
-            await asyncio.sleep(1)
-            collected_data = []
-            next_page_good = 1
-
-            while next_page_good:
-                i = 0
-                await asyncio.sleep(0.3)
-                cards_page_good = 1
-
-                while cards_page_good:
-                    await asyncio.sleep(0.1)
-                    try:
-                        element = driver.find_element(
-                            By.CSS_SELECTOR, f'article[data-card-index="{i}"]')
-                        driver.execute_script(
-                            "arguments[0].scrollIntoView();", element)
-
-                        for _ in range(14):
-                            try:
-                                content = driver.find_element(
-                                    By.CSS_SELECTOR, f'article[data-card-index="{i}"]')
-                                id = int(content.get_attribute("id")[1:])
-                                price = int(content.find_element(
-                                    By.CLASS_NAME, 'price__lower-price').text[:-2].replace(' ', ''))
-                                name = content.find_element(
-                                    By.CLASS_NAME, f'product-card__name').text
 
-                                try:
-                                    grade = content.find_element(
-                                        By.CLASS_NAME, f'address-rate-mini').text
-                                except Exception:
-                                    grade = '0'
-
-                                collected_data.append([])
-                                collected_data[-1].append(id)
-                                collected_data[-1].append(price)
-                                collected_data[-1].append(name)
-                                collected_data[-1].append(grade)
-                                i += 1
-                            except Exception:
-                                cards_page_good = 0
-                        await asyncio.sleep(0.2)
-                    except Exception:
-                        cards_page_good = 0
+def get_file_number(file_path: str):
+    """
+    Извлекает порядковый номер снимка из имени файла.
 
-                try:
-                    element_for_next = driver.find_element(
-                        By.CLASS_NAME, "pagination-next")
-                    element_for_next.send_keys(Keys.RETURN)
-                except Exception:
-                    next_page_good = 0
-
-            driver.close()
-            return collected_data
-        except Exception as e:
-            print(f"Ошибка при парсинге страницы: {e}")
-            try:
-                driver.close()
-            except:
-                pass
-            raise
-    except Exception as e:
-        print(f"Общая ошибка в main_parser: {e}")
-        raise
+    Args:
+        file_path (str): Путь к файлу снимка.
+
+    Returns:
+        number (int): Порядковый номер файла или -1, если имя не соответствует шаблону.
+    """
+    parsed = parse_snapshot_name(file_path)
+    return parsed[2] if parsed else -1
 
 
-def sorted_data(collected_data: list):
+def list_snapshots(user_id: int, category: str = None):
     """
-    Сортирует по артикулу и убирает дубликаты в списке.
+    Возвращает файлы снимков пары (пользователь, категория) по возрастанию номера.
 
     Args:
-        collected_data (List[List[Union[int, str]]]): Список списков с данными о товарах. Каждый внутренний элемент содержит:
-              [артикул (int), цена (int), название (str), рейтинг (str)]
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
 
     Returns:
-        collected_data (List[List[Union[int, str]]]): Первоначальный список, отсортированный по возрастанию первого элемента(артикула).
-              В списке отсутствуют дублирующие строчки.
-              Каждый внутренний список содержит: [артикул (int), цена (int), название (str), рейтинг (str)]
+        paths (List[str]): Пути к файлам снимков.
+    """
+    key = None if category is None else category_key(category)
+    paths = []
+    for path in glob.glob(f'elements_{user_id}_*.csv'):
+        parsed = parse_snapshot_name(path)
+        if parsed and parsed[0] == str(user_id) and parsed[1] == key:
+            paths.append(path)
+    return sorted(paths, key=get_file_number)
 
-    Raises:
-        Exception: Ошибки при сортировке.
+
+def list_streams():
+    """
+    Находит все пары (пользователь, ключ категории), для которых есть снимки или сегменты истории.
+
+    Returns:
+        streams (Set[Tuple[str, str or None]]): Множество пар (user_id, ключ категории).
+    """
+    streams = set()
+    for path in glob.glob('elements_*.csv'):
+        parsed = parse_snapshot_name(path)
+        if parsed:
+            streams.add(parsed[:2])
+    for path in glob.glob('history_*.csv.gz'):
+        parts = os.path.basename(path)[len('history_'):-len('.csv.gz')].split('.')[0].split('_')
+        if len(parts) in (1, 2):
+            streams.add((parts[0], parts[1] if len(parts) == 2 else None))
+    return streams
+
+
+def next_counter(user_id: int, category: str = None):
+    """
+    Определяет номер следующего снимка, чтобы перезапуск парсинга
+    не перезаписывал уже сохраненную историю.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
+
+    Returns:
+        counter (int): Номер, больший всех существующих номеров снимков категории.
+    """
+    numbers = [get_file_number(path) for path in list_snapshots(user_id, category)]
+    return max(numbers, default=-1) + 1
+
+
+def load_segment(path: str):
+    """
+    Читает все строки сжатого сегмента истории. Поврежденный хвост сегмента
+    (например, после сбоя посреди записи) отбрасывается вместе с последней
+    прочитанной строкой, которая могла оказаться обрезанной.
+
+    Args:
+        path (str): Путь к сегменту.
+
+    Returns:
+        result (Tuple[List[List[str]], bool]): Строки [время, артикул, цена] и признак
+              того, что сегмент прочитан целиком без ошибок.
     """
+    rows = []
     try:
-        collected_data = sorted(collected_data, key=lambda x: x[0])
-        i = 0
-        while i < len(collected_data):
-            j = i + 1
-            while j < len(collected_data):
-                if collected_data[i][0] == collected_data[j][0]:
-                    collected_data.pop(j)
-                else:
-                    j += 1
-            i += 1
-        return collected_data
-    except Exception as e:
-        print(f"Ошибка в сортировке файла: {e}")
-        raise
+        with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                if len(row) == 3:
+                    rows.append(row)
+        return rows, True
+    except FileNotFoundError:
+        return [], True
+    except (EOFError, OSError, zlib.error, UnicodeDecodeError, csv.Error) as e:
+        print(f"Сегмент истории {path} поврежден, прочитано строк: {max(len(rows) - 1, 0)}: {e}")
+        return rows[:-1], False
+
+
+def read_history_segment(user_id: int, article: str = None, category: str = None):
+    """
+    Читает сжатые сегменты холодной истории пользователя.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        article (str or None): Артикул для фильтрации. Если None, возвращаются все строки.
+        category (str or None): Категория товаров.
+
+    Returns:
+        rows (List[List[str]]): Строки сегментов [время (str), артикул (str), цена (str)]
+              в порядке записи. Пустой список, если сегментов нет.
+    """
+    paths = [segment_path(user_id, category)] + [path for _, path in list_segments(user_id, category)]
+    rows = []
+    seen = set()
+    for path in paths:
+        for row in load_segment(path)[0]:
+            # Контрольные строки в начале месячного сегмента повторяют уже прочитанные записи
+            if tuple(row) in seen:
+                continue
+            seen.add(tuple(row))
+            if article is None or row[1] == article:
+                rows.append(row)
+    return rows
 
-def save_to_csv(data: list, counter: int, user_id: int):
+
+def load_history_state(user_id: int, category: str = None):
     """
-    Сохраняет данные парсинга в CSV файл с добавлением временной метки.
+    Читает последние цены товаров, записанные в помесячные сегменты истории.
+    Если файла состояния нет, состояние восстанавливается чтением сегментов.
 
     Args:
-        data (List[List[Union[int, str]]]): Список списков с данными о товарах [артикул (int), цена (int), название (str), рейтинг(str)]
-        counter (int): Порядковый номер файла.
         user_id (int): ID пользователя Telegram.
+        category (str or None): Категория товаров.
+
+    Returns:
+        state (Dict[str, Tuple[str, str]]): {артикул: (цена, время записи)}.
+    """
+    try:
+        return {row[0]: (row[1], row[2])
+                for row in read_csv_rows(history_state_path(user_id, category)) if len(row) == 3}
+    except FileNotFoundError:
+        pass
+    state = {}
+    for _, path in list_segments(user_id, category):
+        for timestamp, article, price in load_segment(path)[0]:
+            current = state.get(article)
+            if current is None or sortable_timestamp(timestamp) >= sortable_timestamp(current[1]):
+                state[article] = (price, timestamp)
+    return state
+
+
+def store_segment(path: str, rows: list):
+    """
+    Дописывает строки в сегмент истории через временный файл и атомарное переименование.
+
+    Целый сегмент копируется и дополняется новым gzip-member (при чтении они
+    склеиваются), отсутствующий или поврежденный записывается заново из
+    восстановленных строк. Новый сегмент читается обратно и сбрасывается на диск
+    до подмены старого.
+
+    Args:
+        path (str): Путь к сегменту.
+        rows (List[List[str]]): Строки [время, артикул, цена].
+
+    Returns:
+        None
 
     Raises:
-        Exception: При возникновении любых ошибок ввода-вывода или обработки данных.
+        OSError: Если записанный сегмент не прочитался обратно.
+    """
+    existing_rows, intact = load_segment(path)
+    # Временный файл, оставшийся от прерванного запуска, перезаписывается.
+    tmp_path = f'{path}.tmp'
+    if intact and os.path.exists(path):
+        shutil.copyfile(path, tmp_path)
+        mode, rows_to_write = 'at', rows
+    else:
+        mode, rows_to_write = 'wt', existing_rows + rows
+    with gzip.open(tmp_path, mode, newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerows(rows_to_write)
+    written_rows, written_intact = load_segment(tmp_path)
+    if not written_intact or written_rows != existing_rows + rows:
+        os.remove(tmp_path)
+        raise OSError(f"Сегмент истории {tmp_path} не прочитался после записи")
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory()
+
+
+def downsample_segments(user_id: int, before_month: str, category: str = None):
+    """
+    Прореживает сегменты месяцев раньше before_month до одной точки в день:
+    для каждого товара остается последняя цена дня, если она отличается
+    от предыдущей сохраненной.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        before_month (str): Первый месяц 'ГГГГ-ММ', который остается в почасовом разрешении.
+        category (str or None): Категория товаров.
 
     Returns:
-        None: Функция не возвращает значения, только создает файл.
+        downsampled (int): Количество прореженных сегментов.
     """
-    try:
-        data.append([datetime.now().strftime('%d.%m.%Y %H:%M:%S')])
-        filename = f'elements_{user_id}_{counter}.csv'
-        with open(filename, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            for element_id in data:
-                writer.writerow(element_id)
-    except Exception as e:
-        print(f"Ошибка сохранения в CSV для пользователя {user_id}: {e}")
-        raise
+    downsampled = 0
+    for month, path in list_segments(user_id, category):
+        if month >= before_month:
+            break
+        hourly_path = segment_path(user_id, category, month)
+        if path != hourly_path:
+            if os.path.exists(hourly_path):
+                os.remove(hourly_path)
+            continue
+
+        rows, _ = load_segment(path)
+        kept = [row for row in rows if history_month(row[0]) < month]  # контрольные строки
+        previous = {article: price for _, article, price in kept}
+        last_of_day = {}
+        for row in rows:
+            if history_month(row[0]) == month:
+                last_of_day[(row[0][:10], row[1])] = row
+        for row in sorted(last_of_day.values(), key=lambda row: sortable_timestamp(row[0])):
+            if previous.get(row[1]) != row[2]:
+                previous[row[1]] = row[2]
+                kept.append(row)
+        store_segment(segment_path(user_id, category, month, daily=True), kept)
+        os.remove(path)
+        downsampled += 1
+    return downsampled
+
+
+def compact_snapshots(user_id: int, keep_recent: int = KEEP_RECENT_SNAPSHOTS, category: str = None):
+    """
+    Сжимает старые снимки пользователя в помесячные gzip-сегменты истории.
+
+    Последние keep_recent снимков остаются без изменений. Из более старых
+    сохраняется по одному снимку на час, а из него в сегмент его месяца попадают
+    только те товары, цена которых изменилась с последней записи. Последние
+    записанные цены хранятся в файле состояния, поэтому накопленная история
+    при сжатии не читается. Новый месячный сегмент начинается с контрольных
+    строк - последних цен всех товаров, - чтобы состояние на любой момент
+    восстанавливалось по одному сегменту. Сегменты месяцев старше
+    DAILY_HISTORY_AFTER_DAYS от последнего снимка прореживаются до точки в день,
+    единый сегмент прежнего формата переносится в помесячные.
+    Обработанные CSV файлы удаляются только после того, как сегменты
+    и состояние сброшены на диск.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        keep_recent (int): Количество последних снимков, хранимых в полном разрешении.
+        category (str or None): Категория товаров.
+
+    Returns:
+        removed (int): Количество удаленных CSV файлов.
+    """
+    user_files = list_snapshots(user_id, category)
+    old_files = user_files[:-keep_recent] if keep_recent > 0 else user_files
+    if not old_files:
+        return 0
+
+    last_prices = load_history_state(user_id, category)
+    legacy_path = segment_path(user_id, category)
+    points = load_segment(legacy_path)[0]
+
+    hourly = {}
+    for file_path in old_files:
+        with open(file_path, 'r', newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        if not rows or len(rows[-1]) != 1:
+            continue
+        timestamp = rows[-1][0]
+        # Формат '%d.%m.%Y %H:%M:%S': первые 13 символов - дата и час
+        hourly[timestamp[:13]] = (timestamp, rows[:-1])
+    for timestamp, rows in hourly.values():
+        points.extend([timestamp, row[0], row[1]] for row in rows if len(row) >= 2)
+
+    segments = dict(list_segments(user_id, category))
+    new_rows = {}  # {месяц: строки}
+    for timestamp, article, price in points:
+        previous = last_prices.get(article)
+        # Записи не новее сохраненной (повторное сжатие после сбоя) пропускаются
+        if previous is not None and (previous[0] == price
+                                     or sortable_timestamp(timestamp) <= sortable_timestamp(previous[1])):
+            continue
+        month = history_month(timestamp)
+        if month not in new_rows:
+            new_rows[month] = [] if month in segments else [
+                [last_timestamp, last_article, last_price]
+                for last_article, (last_price, last_timestamp) in last_prices.items()]
+        new_rows[month].append([timestamp, article, price])
+        last_prices[article] = (price, timestamp)
+
+    for month, rows in new_rows.items():
+        store_segment(segments.get(month, segment_path(user_id, category, month)), rows)
+    state_path = history_state_path(user_id, category)
+    if new_rows or not os.path.exists(state_path):
+        write_csv_atomic(state_path, [[article, price, timestamp]
+                                      for article, (price, timestamp) in last_prices.items()], fsync=True)
+        fsync_directory()
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+    for file_path in old_files:
+        os.remove(file_path)
+
+    newest = read_snapshot_timestamp(user_files[-1])
+    if newest is not None:
+        downsample_segments(
+            user_id, (newest - timedelta(days=DAILY_HISTORY_AFTER_DAYS)).strftime('%Y-%m'), category)
+    return len(old_files)
+
+
+async def compaction_task(interval_minutes: int = COMPACTION_INTERVAL_MINUTES):
+    """
+    Фоновая задача периодического сжатия истории всех пользователей
+    и журнала каталога товаров. Работа с файлами выполняется в отдельном потоке, чтобы не блокировать бота.
+
+    Args:
+        interval_minutes (int): Интервал между запусками сжатия в минутах.
+
+    Returns:
+        None: Функция не возвращает значения, работает до отмены.
+    """
+    while True:
+        try:
+            streams = await asyncio.to_thread(list_streams)
+            try:
+                scrape_cache.purge_expired()
+                await asyncio.to_thread(scrape_cache.purge_disk)
+            except Exception as e:
+                print(f"Ошибка очистки кэша парсинга: {e}")
+            for user_id, key in streams:
+                try:
+                    removed = await asyncio.to_thread(
+                        compact_snapshots, user_id, KEEP_RECENT_SNAPSHOTS, key)
+                    if removed:
+                        invalidate_queries(user_id)
+                        print(f"Сжато снимков для пользователя {user_id} ({key}): {removed}")
+                except Exception as e:
+                    print(f"Ошибка сжатия истории для пользователя {user_id} ({key}): {e}")
+            catalog_future = compact_catalog()
+            if catalog_future is not None:
+                await asyncio.wrap_future(catalog_future)
+        except Exception as e:
+            print(f"Ошибка в задаче сжатия истории: {e}")
+        await asyncio.sleep(60*interval_minutes)
+
+
+async def notify_watchers(changes: list, bot: Bot):
+    """
+    Отправляет уведомления пользователям, у которых сработали правила отслеживания.
+
+    Args:
+        changes (List[Tuple[str, int or None, int]]): Список изменений [(артикул, старая цена, новая цена)].
+        bot (Bot): Экземпляр бота Telegram для отправки сообщений.
+
+    Returns:
+        None: Функция не возвращает значения, только отправляет уведомления.
+    """
+    for user_id, text in check_watchlists(changes):
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+        except Exception as e:
+            print(f"Ошибка отправки уведомления об отслеживании пользователю {user_id}: {e}")
+
+def compare_snapshots(rows1: list, rows2: list):
+    """
+    Сравнивает два снимка по артикулам.
+
+    Args:
+        rows1 (List[List[str]]): Предыдущий снимок, последняя строка - временная метка.
+        rows2 (List[List[str]]): Текущий снимок, последняя строка - временная метка.
+
+    Returns:
+        result (Tuple[list, list, list]): Новые строки, удаленные строки и пары (старая строка, новая строка)
+              для товаров с изменившейся ценой. Строки упорядочены по артикулу.
+    """
+    old = {row[0]: row for row in rows1[:-1] if len(row) >= 2}
+    new = {row[0]: row for row in rows2[:-1] if len(row) >= 2}
+
+    def article_order(article):
+        return (0, int(article)) if article.isdigit() else (1, article)
+
+    new_rows = [new[article] for article in sorted(new.keys() - old.keys(), key=article_order)]
+    removed_rows = [old[article] for article in sorted(old.keys() - new.keys(), key=article_order)]
+    changed_rows = [(old[article], new[article])
+                    for article in sorted(new.keys() & old.keys(), key=article_order)
+                    if old[article][1] != new[article][1]]
+    return new_rows, removed_rows, changed_rows
+
 
-async def parsing_analysis(counter: int, bot: Bot, chat_id: int):
+async def parsing_analysis(counter: int, bot: Bot, chat_id: int, category: str = None):
     """
     Анализирует различия между двумя последовательными CSV файлами.
     Результаты анализа отправляются пользователю в Telegram чат.
@@ -238,6 +1805,7 @@ async def parsing_analysis(counter: int, bot: Bot, chat_id: int):
         counter (int): Номер текущей итерации парсинга.
         bot (Bot): Экземпляр бота Telegram для отправки сообщений.
         chat_id (int): Идентификатор чата Telegram (user_id).
+        category (str or None): Категория товаров.
 
     Returns:
         None: Функция не возвращает значения, только выводит пользователю информацию о изменениях.
@@ -247,23 +1815,21 @@ async def parsing_analysis(counter: int, bot: Bot, chat_id: int):
         user_id = chat_id
 
         try:
-            with open(f'elements_{user_id}_{counter-1}.csv', 'r', encoding='utf-8') as f1:
-                reader1 = csv.reader(f1)
-                rows1 = list(reader1)
+            rows1 = await load_snapshot(user_id, counter-1, category)
         except FileNotFoundError:
             await bot.send_message(chat_id=chat_id, text="Предыдущий файл данных не найден.")
             return
 
         try:
-            with open(f'elements_{user_id}_{counter}.csv', 'r', encoding='utf-8') as f2:
-                reader2 = csv.reader(f2)
-                rows2 = list(reader2)
+            rows2 = await load_snapshot(user_id, counter, category)
         except FileNotFoundError:
             await bot.send_message(chat_id=chat_id, text="Текущий файл данных не найден.")
             return
 
         differences = False
         message_parts = []
+        if category is not None:
+            message_parts.append(f'Категория "{category}":')
 
         if len(rows1) != len(rows2):
             differences = True
@@ -276,30 +1842,14 @@ async def parsing_analysis(counter: int, bot: Bot, chat_id: int):
         else:
             message_parts.append("Количество товаров не изменилось")
 
-        i = j = 0
-        new_items = []
-        removed_items = []
-        price_changes = []
-        while i < len(rows1)-1 and j < len(rows2)-1:
-            try:
-                if rows1[i] != rows2[j]:
-                    differences = True
-                    if rows1[i][0] != rows2[j][0]:
-                        if j+1 < len(rows2) and rows1[i][0] == rows2[j+1][0]:
-                            new_items.append(
-                                f'Артикул: {rows2[j][0]}, Имя: {rows2[j][2]}, Цена: {rows2[j][1]}')
-                            j += 1
-                        elif i+1 < len(rows1) and rows1[i+1][0] == rows2[j][0]:
-                            removed_items.append(
-                                f'Артикул: {rows1[i][0]}, Имя: {rows1[i][2]}, Цена: {rows1[i][1]}')
-                            i += 1
-                    elif rows1[i][1] != rows2[j][1]:
-                        price_changes.append(
-                            f'Цена товара {rows2[j][0]} изменилась на {int(rows2[j][1]) - int(rows1[i][1])} руб.')
-            except Exception as e:
-                print(f"Ошибка при сравнении строк: {e}")
-            i += 1
-            j += 1
+        new_rows, removed_rows, changed_rows = compare_snapshots(rows1, rows2)
+        differences = differences or bool(new_rows or removed_rows or changed_rows)
+        new_items = [f'Артикул: {row[0]}, Имя: {row[2]}, Цена: {row[1]}' for row in new_rows]
+        removed_items = [f'Артикул: {row[0]}, Имя: {row[2]}, Цена: {row[1]}' for row in removed_rows]
+        price_changes = [f'Цена товара {new[0]} изменилась на {int(new[1]) - int(old[1])} руб.'
+                         for old, new in changed_rows]
+        changed_articles = [(row[0], None, int(row[1])) for row in new_rows]
+        changed_articles += [(new[0], int(old[1]), int(new[1])) for old, new in changed_rows]
 
         if differences:
             if new_items:
@@ -324,41 +1874,38 @@ async def parsing_analysis(counter: int, bot: Bot, chat_id: int):
                 chat_id=chat_id,
                 text=message_text,
             )
+
+        if bot and changed_articles:
+            await notify_watchers(changed_articles, bot)
     except Exception as e:
         print(f"Ошибка в parsing_analysis: {e}")
         if bot and chat_id:
             await bot.send_message(chat_id=chat_id, text=f"Ошибка при анализе данных: {str(e)}")
 
 
-async def show_article_price(article: str, user_id: int):
+def article_history(article: str, user_id: int):
     """
-    Извлекает историю цен для указанного артикула из CSV файлов парсинга.
+    Собирает историю цен артикула по всем категориям пользователя
+    из сжатых сегментов и CSV файлов парсинга.
 
     Args:
         article (str): Артикул товара для поиска в истории.
         user_id (int): ID пользователя Telegram.
 
     Returns:
-        message_text (str): Отформатированный текст с историей цен.
+        history (List[Tuple[str, int]] or None): Список пар (время, цена) в хронологическом порядке
+              или None, если у пользователя еще нет истории парсинга.
     """
-    try:
-        message_text = f"История цены артикула {article}:\n\n"
-        found_any = False
-
-        user_files = glob.glob(f'elements_{user_id}_*.csv')
-
-        if not user_files:
-            return f"Для вашей категории еще нет истории парсинга."
-
-        def get_file_number(file_path):
-            try:
-                return int(file_path.split('_')[2].split('.')[0])
-            except:
-                return -1
+    keys = [key for stream_user, key in list_streams() if stream_user == str(user_id)]
+    if not keys:
+        return None
 
-        user_files.sort(key=get_file_number)
+    history = {}  # упорядоченное множество пар (время, цена)
+    for key in keys:
+        for timestamp, _, price in read_history_segment(user_id, article, key):
+            history[(timestamp, int(price))] = None
 
-        for file_path in user_files:
+        for file_path in list_snapshots(user_id, key):
             try:
                 with open(file_path, 'r', encoding='utf-8') as f:
                     lines = f.readlines()
@@ -368,9 +1915,7 @@ async def show_article_price(article: str, user_id: int):
                             parts = line.strip().split(',')
                             if parts[0] == article:
                                 try:
-                                    price = int(parts[1])
-                                    message_text += f"Время: {last_line}\nЦена: {price} руб.\n\n"
-                                    found_any = True
+                                    history[(last_line, int(parts[1]))] = None
                                 except (ValueError, IndexError):
                                     continue
                                 break
@@ -378,102 +1923,173 @@ async def show_article_price(article: str, user_id: int):
                 print(f"Ошибка чтения файла {file_path}: {e}")
                 continue
 
-        if not found_any:
-            message_text = f"Артикул {article} не найден в истории вашей категории."
+    def timestamp_key(item):
+        try:
+            return datetime.strptime(item[0], '%d.%m.%Y %H:%M:%S')
+        except ValueError:
+            return datetime.min
+
+    return sorted(history, key=timestamp_key)
+
+
+async def show_article_price(article: str, user_id: int):
+    """
+    Извлекает историю цен для указанного артикула из CSV файлов парсинга.
+    Чтение файлов выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+
+    Args:
+        article (str): Артикул товара для поиска в истории.
+        user_id (int): ID пользователя Telegram.
+
+    Returns:
+        message_text (str): Отформатированный текст с историей цен.
+    """
+    try:
+        history = await asyncio.to_thread(article_history, article, user_id)
+
+        if history is None:
+            return f"Для вашей категории еще нет истории парсинга."
+
+        if not history:
+            return f"Артикул {article} не найден в истории вашей категории."
+
+        message_text = f"История цены артикула {article}:\n\n"
+        for timestamp, price in history:
+            message_text += f"Время: {timestamp}\nЦена: {price} руб.\n\n"
+        return message_text
+    except Exception as e:
+        print(f"Ошибка в show_article_price для пользователя {user_id}: {e}")
+        return f"Не удалось получить историю цены артикула {article}."
+
+
+async def process_category(user_id: int, category: str, interval_minutes: int, parsing_data,
+                           counter: int, bot: Bot):
+    """
+    Обрабатывает результат парсинга одной категории: сортирует, сохраняет снимок,
+    сообщает о самом дешевом товаре и об изменениях с прошлого снимка.
+
+    Args:
+        user_id (int): ID пользователя Telegram.
+        category (str): Категория товаров.
+        interval_minutes (int): Интервал между парсингами категории в минутах.
+        parsing_data (Union[list, Exception]): Результат parse_categories для категории.
+        counter (int): Номер снимка категории.
+        bot (Bot): Экземпляр бота Telegram.
+
+    Returns:
+        saved (bool): True, если снимок сохранен и номер снимка нужно увеличить.
+    """
+    if isinstance(parsing_data, Exception):
+        await bot.send_message(user_id, f'Ошибка при выполнении парсинга категории "{category}": {str(parsing_data)}')
+        return False
+
+    try:
+        parsing_data = sorted_data(parsing_data)
+    except Exception as e:
+        await bot.send_message(user_id, f"Ошибка при сортировке данных: {str(e)}")
+        return False
 
-        return message_text
+    try:
+        await save_snapshot(parsing_data, counter, user_id, category)
     except Exception as e:
-        print(f"Ошибка в show_article_price для пользователя {user_id}: {e}")
-        return
+        await bot.send_message(user_id, f"Ошибка сохранения данных: {str(e)}")
+        return False
+
+    try:
+        cheapest = the_cheapest(parsing_data)
+        if cheapest:
+            await bot.send_message(
+                user_id,
+                f'Самый дешёвый товар в категории "{category}":\n'
+                f'Артикул: {cheapest[0]}\n'
+                f'Цена: {cheapest[1]} руб.\n'
+                f'Имя: {cheapest[2]}'
+            )
+    except Exception as e:
+        print(
+            f"Ошибка отправки информации о самом дешевом товаре для пользователя {user_id}: {e}")
+
+    if os.path.exists(snapshot_path(user_id, counter-1, category)):
+        try:
+            await parsing_analysis(counter, bot, user_id, category)
+        except Exception as e:
+            print(
+                f"Ошибка анализа данных для пользователя {user_id}: {e}")
+            await bot.send_message(user_id, f"Ошибка анализа изменений: {str(e)}")
 
+    try:
+        await bot.send_message(
+            user_id,
+            f'Парсинг категории "{category}" завершен. '
+            f'Следующий через {interval_minutes} минут.'
+        )
+    except Exception as e:
+        print(
+            f"Ошибка отправки сообщения о завершении для пользователя {user_id}: {e}")
+    return True
 
-async def start_parsing_task(user_id: int, category: str, interval_minutes: int, bot: Bot):
+
+async def start_parsing_task(user_id: int, bot: Bot):
     """
-    Запускает фоновую задачу парсинга для конкретного пользователя.
+    Запускает фоновую задачу парсинга всех категорий пользователя.
+
+    Категории, срок обновления которых наступил или наступит в течение
+    DUE_WINDOW_SECONDS, парсятся подряд в одной браузерной сессии. Следующий
+    срок отсчитывается от начала цикла, поэтому категории с одинаковым
+    интервалом остаются в одном цикле. Состав категорий берется из subscriptions и может
+    меняться во время работы задачи: добавление категории будит задачу
+    через subscription_events.
 
     Args:
         user_id (int): ID пользователя Telegram.
-        category (str): Категория товаров для парсинга.
-        interval_minutes (int): Интервал между парсингами в минутах.
         bot (Bot): Экземпляр бота Telegram.
 
     Returns:
         None: Функция не возвращает значения, только запускает задачу парсинга.
 
     """
-    counter = 0
+    next_runs = {}  # {category: time.monotonic()} - когда категорию пора парсить
+    counters = {}  # {category: номер следующего снимка}
+    wakeup = subscription_events.setdefault(user_id, asyncio.Event())
 
     while True:
         try:
-            try:
-                await bot.send_message(user_id, f'Начинаем парсинг категории "{category}"...')
-            except Exception as e:
-                print(
-                    f"Ошибка отправки сообщения о начале парсинга для пользователя {user_id}: {e}")
-
-            try:
-                parsing_data = await main_parser(category)
-            except Exception as e:
-                await bot.send_message(user_id, f"Ошибка при выполнении парсинга: {str(e)}")
-                await asyncio.sleep(60)
-                continue
-
-            try:
-                parsing_data = sorted_data(parsing_data)
-            except Exception as e:
-                await bot.send_message(user_id, f"Ошибка при сортировке данных: {str(e)}")
-                await asyncio.sleep(60)
-                continue
-
-            try:
-                save_to_csv(parsing_data, counter, user_id)
-            except Exception as e:
-                await bot.send_message(user_id, f"Ошибка сохранения данных: {str(e)}")
-                await asyncio.sleep(60)
-                continue
-
-            try:
-                cheapest = the_cheapest(parsing_data)
-                if cheapest:
-                    await bot.send_message(
-                        user_id,
-                        f'Самый дешёвый товар:\n'
-                        f'Артикул: {cheapest[0]}\n'
-                        f'Цена: {cheapest[1]} руб.\n'
-                        f'Имя: {cheapest[2]}'
-                    )
-            except Exception as e:
-                print(
-                    f"Ошибка отправки информации о самом дешевом товаре для пользователя {user_id}: {e}")
-
-            if counter > 0:
+            wakeup.clear()
+            categories = dict(subscriptions.get(user_id, {}))
+            if not categories:
+                break
+
+            now = time.monotonic()
+            due = [category for category in categories
+                   if next_runs.get(category, 0) <= now + DUE_WINDOW_SECONDS]
+            if due:
                 try:
-                    await parsing_analysis(counter, bot, user_id)
+                    await bot.send_message(
+                        user_id, 'Начинаем парсинг категорий: ' + ', '.join(f'"{c}"' for c in due) + '...')
                 except Exception as e:
                     print(
-                        f"Ошибка анализа данных для пользователя {user_id}: {e}")
-                    await bot.send_message(user_id, f"Ошибка анализа изменений: {str(e)}")
-
-            counter += 1
-
+                        f"Ошибка отправки сообщения о начале парсинга для пользователя {user_id}: {e}")
+
+                # Страницы не старше половины самого короткого интервала переиспользуются из кэша
+                results = await parse_categories(
+                    due, max_age_seconds=30*min(categories[c] for c in due))
+
+                for category in due:
+                    if category not in counters:
+                        counters[category] = next_counter(user_id, category)
+                    saved = await process_category(
+                        user_id, category, categories[category], results[category], counters[category], bot)
+                    if saved:
+                        counters[category] += 1
+                        next_runs[category] = now + 60*categories[category]
+                    else:
+                        next_runs[category] = now + 60
+
+            delay = min(next_runs.get(category, 0) for category in categories) - time.monotonic()
             try:
-                await bot.send_message(
-                    user_id,
-                    f'Парсинг категории "{category}" завершен. '
-                    f'Следующий через {interval_minutes} минут.'
-                )
-            except Exception as e:
-                print(
-                    f"Ошибка отправки сообщения о завершении для пользователя {user_id}: {e}")
-
-            try:
-                await asyncio.sleep(60*interval_minutes)
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                print(
-                    f"Ошибка во время ожидания для пользователя {user_id}: {e}")
-                await asyncio.sleep(60)
+                await asyncio.wait_for(wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
 
         except asyncio.CancelledError:
             try:
@@ -505,10 +2121,12 @@ class Register(StatesGroup):
         name (State): Состояние ввода названия категории товаров.
         time (State): Состояние ввода интервала парсинга в минутах.
         article (State): Состояние ввода артикула товара для отслеживания истории цен.
+        watch (State): Состояние ввода списка артикулов для отслеживания.
     """
     name = State()
     time = State()
     article = State()
+    watch = State()
 
 @router.message(CommandStart())
 async def cmd_start(message: Message):
@@ -586,10 +2204,11 @@ async def register_name(message: Message, state: FSMContext):
 @router.message(Register.time)
 async def parsing(message: Message, state: FSMContext):
     """
-    Завершает регистрацию категории и запускает задачу парсинга.
+    Завершает регистрацию категории и добавляет ее в подписки пользователя.
 
-    Обрабатывает введенный интервал, останавливает предыдущие задачи пользователя
-    (если есть), сохраняет конфигурацию и запускает асинхронную задачу парсинга.
+    Обрабатывает введенный интервал, сохраняет категорию в subscriptions и
+    запускает асинхронную задачу парсинга, если она еще не запущена, либо
+    будит уже работающую задачу, чтобы она подхватила новую категорию.
 
     Args:
         message (Message): Объект входящего сообщения с интервалом парсинга.
@@ -617,14 +2236,24 @@ async def parsing(message: Message, state: FSMContext):
         await state.update_data(time=message.text)
         data = await state.get_data()
 
-        parsing_task = asyncio.create_task(
-            start_parsing_task(user_id, data['name'], interval, message.bot)
-        )
-        parsing_tasks[user_id] = parsing_task
+        user_subscriptions = subscriptions.setdefault(user_id, {})
+        for subscribed in list(user_subscriptions):
+            if category_key(subscribed) == category_key(data['name']):
+                del user_subscriptions[subscribed]
+        user_subscriptions[data['name']] = interval
+
+        task = parsing_tasks.get(user_id)
+        if task is None or task.done():
+            parsing_tasks[user_id] = asyncio.create_task(
+                start_parsing_task(user_id, message.bot)
+            )
+        else:
+            subscription_events.setdefault(user_id, asyncio.Event()).set()
 
         await message.answer(
             f'Вы подписались на категорию "{data["name"]}"\n'
             f'Обновления товаров будут проверяться каждые {data["time"]} минут.\n'
+            f'Всего категорий в подписке: {len(user_subscriptions)}.\n'
             f'Для остановки нажмите "Остановить парсинг"\n\n'
         )
         await state.clear()
@@ -637,7 +2266,8 @@ async def parsing(message: Message, state: FSMContext):
 @router.message(F.text == 'Остановить парсинг')
 async def stop_parsing(message: Message):
     """
-    Останавливает активную задачу парсинга для текущего пользователя.
+    Останавливает активную задачу парсинга для текущего пользователя
+    и удаляет все его подписки на категории.
 
     Args:
         message (Message): Объект входящего сообщения от пользователя 'Остановить парсинг'.
@@ -645,6 +2275,8 @@ async def stop_parsing(message: Message):
     user_id = message.from_user.id
 
     try:
+        subscriptions.pop(user_id, None)
+        subscription_events.pop(user_id, None)
         if user_id in parsing_tasks:
             task = parsing_tasks[user_id]
             if not task.done():
@@ -709,6 +2341,531 @@ async def article(message: Message, state: FSMContext):
         await state.clear()
 
 
+@router.message(F.text == 'Отслеживать артикулы')
+async def show_watchlist(message: Message, state: FSMContext):
+    """
+    Показывает текущий список отслеживания и запрашивает изменения к нему.
+
+    Args:
+        message (Message): Входящее сообщение от пользователя с текстом 'Отслеживать артикулы'.
+        state (FSMContext): Контекст конечного автомата состояний.
+
+    """
+    try:
+        user_watchlist = watchlists.get(message.from_user.id, {})
+        if user_watchlist:
+            lines = [f'{article}: {f"цель {target} руб." if target is not None else "любое снижение"}'
+                     for article, target in list(user_watchlist.items())[:50]]
+            await message.answer(f"Отслеживается артикулов: {len(user_watchlist)}\n" + "\n".join(lines))
+        await message.answer(
+            "Введите артикулы, по одному на строке:\n"
+            "<артикул> - уведомлять о любом снижении цены\n"
+            "<артикул> <цена> - уведомлять, когда цена опустится до указанной\n"
+            "-<артикул> - убрать артикул из отслеживания")
+        await state.set_state(Register.watch)
+    except Exception as e:
+        print(f"Ошибка при показе списка отслеживания: {e}")
+        await message.answer("Произошла ошибка. Попробуйте позже.")
+
+
+@router.message(Register.watch)
+async def watch(message: Message, state: FSMContext):
+    """
+    Обновляет список отслеживания пользователя по введенным строкам.
+
+    Args:
+        message (Message): Входящее сообщение со списком артикулов.
+        state (FSMContext): Контекст конечного автомата состояний.
+
+    """
+    user_id = message.from_user.id
+    try:
+        added = removed = 0
+        errors = []
+        for line in message.text.splitlines():
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0].startswith('-'):
+                if remove_from_watchlist(user_id, parts[0][1:]):
+                    removed += 1
+                continue
+            try:
+                if not parts[0].isdigit():
+                    raise ValueError
+                target_price = int(parts[1]) if len(parts) > 1 else None
+                add_to_watchlist(user_id, parts[0], target_price)
+                added += 1
+            except ValueError:
+                errors.append(line.strip())
+
+        if added or removed:
+            await asyncio.wrap_future(snapshot_writer.submit(save_watchlists, watchlist_rows()))
+
+        text = f"Добавлено: {added}, удалено: {removed}."
+        if errors:
+            text += "\nНе удалось разобрать строки:\n" + "\n".join(errors[:10])
+        await message.answer(text)
+        await state.clear()
+    except Exception as e:
+        print(f"Ошибка при обновлении списка отслеживания для пользователя {user_id}: {e}")
+        await message.answer(f"Произошла ошибка при обновлении списка отслеживания: {str(e)}")
+        await state.clear()
+
+
+def invalidate_queries(user_id):
+    """
+    Удаляет из кэша API все результаты запросов по данным пользователя.
+
+    Args:
+        user_id (Union[int, str]): ID пользователя Telegram.
+
+    Returns:
+        None
+    """
+    query_generations[str(user_id)] = query_generations.get(str(user_id), 0) + 1
+    for key in [key for key in query_cache if key[0] == str(user_id)]:
+        del query_cache[key]
+
+
+async def cached_query(key: tuple, func, *args):
+    """
+    Возвращает результат запроса из LRU-кэша API или вычисляет его в отдельном потоке.
+
+    Если данные пользователя были изменены, пока результат вычислялся, он
+    возвращается, но не сохраняется в кэше.
+
+    Args:
+        key (tuple): Ключ запроса, первый элемент - ID пользователя (str).
+        func (Callable): Функция, вычисляющая результат.
+        *args: Аргументы функции.
+
+    Returns:
+        result (Any): Результат запроса.
+    """
+    if key in query_cache:
+        query_cache.move_to_end(key)
+        return query_cache[key]
+    generation = query_generations.get(key[0], 0)
+    result = await asyncio.to_thread(func, *args)
+    if query_generations.get(key[0], 0) != generation:
+        return result
+    query_cache[key] = result
+    while len(query_cache) > QUERY_CACHE_SIZE:
+        query_cache.popitem(last=False)
+    return result
+
+
+def row_to_item(row: list):
+    """
+    Преобразует строку снимка в словарь для ответа API.
+
+    Args:
+        row (List[str]): Строка [артикул, цена, название, рейтинг].
+
+    Returns:
+        item (dict): {'article', 'price', 'name', 'rating'}.
+    """
+    return {'article': row[0], 'price': int(row[1]), 'name': row[2], 'rating': row[3]}
+
+
+def parse_timestamp(value: str):
+    """
+    Разбирает время в формате ISO 8601 или '%d.%m.%Y %H:%M:%S'.
+
+    Снимки помечаются местным временем без часового пояса, поэтому время
+    с указанным часовым поясом переводится в местное.
+
+    Args:
+        value (str): Строка со временем.
+
+    Returns:
+        moment (datetime): Разобранное время без часового пояса.
+
+    Raises:
+        ValueError: Если строка не соответствует ни одному формату.
+    """
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, '%d.%m.%Y %H:%M:%S')
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+def read_snapshot_timestamp(path: str):
+    """
+    Читает временную метку снимка из последней строки файла, не читая файл целиком.
+
+    Args:
+        path (str): Путь к файлу снимка.
+
+    Returns:
+        moment (datetime or None): Время снимка или None, если последняя строка не является меткой.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 64, 0))
+        tail = f.read().decode('utf-8', errors='replace').splitlines()
+    try:
+        return datetime.strptime(tail[-1].strip(), '%d.%m.%Y %H:%M:%S')
+    except (IndexError, ValueError):
+        return None
+
+
+def snapshot_index(user_id: str, category: str):
+    """
+    Строит список снимков категории с временем их создания.
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        category (str): Категория товаров или ее ключ.
+
+    Returns:
+        index (List[Tuple[datetime, str]]): Пары (время снимка, путь к файлу) по возрастанию времени.
+    """
+    index = []
+    for path in list_snapshots(user_id, category):
+        moment = read_snapshot_timestamp(path)
+        if moment is not None:
+            index.append((moment, path))
+    index.sort(key=lambda item: item[0])
+    return index
+
+
+def cached_latest_rows(user_id: str, category: str):
+    """
+    Возвращает последний снимок категории из кэша снимков, если он там есть.
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        category (str): Категория товаров или ее ключ.
+
+    Returns:
+        rows (List[List[str]] or None): Строки снимка или None.
+    """
+    cached = snapshot_cache.get(stream_name(user_id, category))
+    if not cached:
+        return None
+    return next(reversed(cached.values()))
+
+
+def query_latest(user_id: str, category: str, rows: list = None):
+    """
+    Возвращает последний снимок категории.
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        category (str): Категория товаров или ее ключ.
+        rows (List[List[str]] or None): Последний снимок из кэша. Если None, снимок читается с диска.
+
+    Returns:
+        result (Tuple[str, List[dict]] or None): Время снимка и товары или None, если снимков нет.
+    """
+    if rows is None:
+        paths = list_snapshots(user_id, category)
+        if not paths:
+            return None
+        rows = read_snapshot(paths[-1])
+    return rows[-1][0], [row_to_item(row) for row in rows[:-1]]
+
+
+def query_cheapest(user_id: str, category: str, n: int, rows: list = None):
+    """
+    Возвращает n самых дешевых товаров последнего снимка категории.
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        category (str): Категория товаров или ее ключ.
+        n (int): Количество товаров.
+        rows (List[List[str]] or None): Последний снимок из кэша. Если None, снимок читается с диска.
+
+    Returns:
+        result (Tuple[str, List[dict]] or None): Время снимка и товары или None, если снимков нет.
+    """
+    latest = query_latest(user_id, category, rows)
+    if latest is None:
+        return None
+    return latest[0], heapq.nsmallest(n, latest[1], key=lambda item: item['price'])
+
+
+def query_history(user_id: str, article: str):
+    """
+    Возвращает историю цен артикула по всем категориям пользователя.
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        article (str): Артикул товара.
+
+    Returns:
+        items (List[dict] or None): Точки истории {'timestamp', 'price'} или None, если истории нет.
+    """
+    history = article_history(article, user_id)
+    if history is None:
+        return None
+    return [{'timestamp': timestamp, 'price': price} for timestamp, price in history]
+
+
+def segment_state(user_id: str, category: str, moment: datetime):
+    """
+    Восстанавливает состояние категории на момент времени по сегментам холодной истории.
+
+    Месячный сегмент начинается с последних цен всех товаров, поэтому читается
+    только последний сегмент, начатый не позже нужного момента. Сегменты хранят
+    только изменения цен, поэтому товар считается присутствующим в выдаче
+    с первой записи о нем, а исчезновение товара не восстанавливается.
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        category (str): Категория товаров или ее ключ.
+        moment (datetime): Момент времени.
+
+    Returns:
+        rows (List[List[str]] or None): Строки [артикул, цена, название, рейтинг] и временная
+              метка последней учтенной записи или None, если записей до этого момента нет.
+    """
+    if os.path.exists(segment_path(user_id, category)):
+        # Единый сегмент прежнего формата еще не перенесен в помесячные
+        rows = read_history_segment(user_id, category=category)
+    else:
+        paths = [path for month, path in list_segments(user_id, category) if month <= moment.strftime('%Y-%m')]
+        if not paths:
+            return None
+        rows = load_segment(paths[-1])[0]
+
+    limit = moment.strftime('%Y%m%d %H:%M:%S')
+    prices = {}
+    timestamp = None
+    for row_timestamp, article, price in rows:
+        if sortable_timestamp(row_timestamp) > limit:
+            continue
+        prices[article] = price
+        if timestamp is None or sortable_timestamp(row_timestamp) > sortable_timestamp(timestamp):
+            timestamp = row_timestamp
+    if timestamp is None:
+        return None
+    load_catalog()
+    return expand_rows([[article, price] for article, price in prices.items()] + [[timestamp]])
+
+
+def query_diff(user_id: str, category: str, moment_from: datetime, moment_to: datetime = None):
+    """
+    Сравнивает снимки категории, актуальные на два момента времени.
+
+    Если на момент времени не осталось CSV снимка (он уже сжат), состояние
+    восстанавливается по сегменту истории (см. segment_state).
+
+    Args:
+        user_id (str): ID пользователя Telegram.
+        category (str): Категория товаров или ее ключ.
+        moment_from (datetime): Начало периода.
+        moment_to (datetime or None): Конец периода. Если None, используется последний снимок.
+
+    Returns:
+        result (Tuple[str, str, List[dict]] or None): Время первого и второго снимка и список изменений
+              {'type': 'new' | 'removed' | 'price', ...} или None, если подходящих снимков нет.
+    """
+    index = snapshot_index(user_id, category)
+    states = []
+    for moment in (moment_from, moment_to):
+        paths = [path for snapshot_moment, path in index if moment is None or snapshot_moment <= moment]
+        if paths:
+            states.append(read_snapshot(paths[-1]))
+        elif moment is not None:
+            states.append(segment_state(user_id, category, moment))
+        else:
+            states.append(None)
+    rows1, rows2 = states
+    if rows1 is None or rows2 is None:
+        return None
+    old = {row[0]: row for row in rows1[:-1]}
+    new = {row[0]: row for row in rows2[:-1]}
+
+    items = []
+    for article, row in new.items():
+        if article not in old:
+            items.append({'type': 'new', **row_to_item(row)})
+        elif old[article][1] != row[1]:
+            items.append({'type': 'price', 'article': article, 'name': row[2],
+                          'old_price': int(old[article][1]), 'new_price': int(row[1])})
+    for article, row in old.items():
+        if article not in new:
+            items.append({'type': 'removed', **row_to_item(row)})
+    return rows1[-1][0], rows2[-1][0], items
+
+
+async def api_response(request, items: list, **extra):
+    """
+    Отдает список с пагинацией в виде JSON или потоком NDJSON при ?stream=1.
+
+    Args:
+        request (web.Request): Входящий запрос с параметрами offset, limit и stream.
+        items (List[dict]): Полный список результатов.
+        **extra: Дополнительные поля JSON-ответа.
+
+    Returns:
+        response (web.StreamResponse): Ответ сервера.
+
+    Raises:
+        ValueError: Если offset отрицательный или limit не положительный.
+    """
+    stream = request.query.get('stream') == '1'
+    offset = int(request.query.get('offset', 0))
+    if offset < 0:
+        raise ValueError("offset не может быть отрицательным")
+    limit = request.query.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError("limit должно быть положительным числом")
+        limit = min(limit, API_MAX_PAGE_SIZE)
+    elif not stream:
+        limit = API_PAGE_SIZE
+    page = items[offset:offset + limit if limit is not None else None]
+
+    if stream:
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson; charset=utf-8'})
+        await response.prepare(request)
+        for start in range(0, len(page), API_STREAM_CHUNK):
+            chunk = page[start:start + API_STREAM_CHUNK]
+            await response.write(''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in chunk).encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    return web.json_response(
+        {**extra, 'total': len(items), 'offset': offset, 'limit': limit, 'items': page},
+        dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+def api_error(status: int, text: str):
+    """
+    Формирует JSON-ответ с ошибкой.
+
+    Args:
+        status (int): HTTP-статус.
+        text (str): Описание ошибки.
+
+    Returns:
+        response (web.Response): Ответ сервера.
+    """
+    return web.json_response({'error': text}, status=status, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+async def api_latest(request):
+    """
+    GET /users/{user_id}/categories/{category}/latest - последний снимок категории.
+    """
+    try:
+        user_id, key = request.match_info['user_id'], category_key(request.match_info['category'])
+        result = await cached_query(
+            (user_id, 'latest', key), query_latest, user_id, key, cached_latest_rows(user_id, key))
+        if result is None:
+            return api_error(404, "Снимки категории не найдены")
+        return await api_response(request, result[1], timestamp=result[0])
+    except ValueError as e:
+        return api_error(400, str(e))
+    except Exception as e:
+        print(f"Ошибка API latest: {e}")
+        return api_error(500, str(e))
+
+
+async def api_cheapest(request):
+    """
+    GET /users/{user_id}/categories/{category}/cheapest?n=10 - самые дешевые товары последнего снимка.
+    """
+    try:
+        user_id, key = request.match_info['user_id'], category_key(request.match_info['category'])
+        n = int(request.query.get('n', 10))
+        if n <= 0:
+            raise ValueError("n должно быть положительным числом")
+        result = await cached_query(
+            (user_id, 'cheapest', key, n), query_cheapest, user_id, key, n, cached_latest_rows(user_id, key))
+        if result is None:
+            return api_error(404, "Снимки категории не найдены")
+        return await api_response(request, result[1], timestamp=result[0])
+    except ValueError as e:
+        return api_error(400, str(e))
+    except Exception as e:
+        print(f"Ошибка API cheapest: {e}")
+        return api_error(500, str(e))
+
+
+async def api_history(request):
+    """
+    GET /users/{user_id}/articles/{article}/history - история цен артикула.
+    """
+    try:
+        user_id, article = request.match_info['user_id'], request.match_info['article']
+        items = await cached_query((user_id, 'history', article), query_history, user_id, article)
+        if items is None:
+            return api_error(404, "История парсинга не найдена")
+        return await api_response(request, items, article=article)
+    except ValueError as e:
+        return api_error(400, str(e))
+    except Exception as e:
+        print(f"Ошибка API history: {e}")
+        return api_error(500, str(e))
+
+
+async def api_diff(request):
+    """
+    GET /users/{user_id}/categories/{category}/diff?from=...&to=... - изменения категории между двумя моментами.
+    """
+    try:
+        user_id, key = request.match_info['user_id'], category_key(request.match_info['category'])
+        if 'from' not in request.query:
+            raise ValueError("Не указан параметр from")
+        moment_from = parse_timestamp(request.query['from'])
+        moment_to = parse_timestamp(request.query['to']) if 'to' in request.query else None
+        result = await cached_query(
+            (user_id, 'diff', key, moment_from, moment_to), query_diff, user_id, key, moment_from, moment_to)
+        if result is None:
+            return api_error(404, "Снимки за указанный период не найдены")
+        return await api_response(request, result[2], **{'from': result[0], 'to': result[1]})
+    except ValueError as e:
+        return api_error(400, str(e))
+    except Exception as e:
+        print(f"Ошибка API diff: {e}")
+        return api_error(500, str(e))
+
+
+def create_api_app():
+    """
+    Создает веб-приложение API только для чтения собранных данных.
+
+    Returns:
+        app (web.Application): Приложение aiohttp с маршрутами API.
+    """
+    app = web.Application()
+    app.router.add_get('/users/{user_id}/categories/{category}/latest', api_latest)
+    app.router.add_get('/users/{user_id}/categories/{category}/cheapest', api_cheapest)
+    app.router.add_get('/users/{user_id}/categories/{category}/diff', api_diff)
+    app.router.add_get('/users/{user_id}/articles/{article}/history', api_history)
+    return app
+
+
+async def start_api(host: str = API_HOST, port: int = API_PORT):
+    """
+    Запускает HTTP API в текущем цикле событий.
+
+    Args:
+        host (str): Адрес для прослушивания.
+        port (int): Порт для прослушивания.
+
+    Returns:
+        runner (web.AppRunner): Запущенный сервер, для остановки вызовите runner.cleanup().
+    """
+    runner = web.AppRunner(create_api_app())
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except Exception:
+        await runner.cleanup()
+        raise
+    return runner
+
+
 async def main():
     """
     Основная функция запуска Telegram бота.
@@ -721,7 +2878,35 @@ async def main():
         dp = Dispatcher()
         dp.include_router(router)
         parsing_tasks.clear()  
-        await dp.start_polling(bot)
+        subscriptions.clear()
+        subscription_events.clear()
+        try:
+            await asyncio.to_thread(resolve_chromedriver)
+        except Exception as e:
+            print(f"Не удалось подготовить chromedriver при запуске: {e}")
+        try:
+            await asyncio.to_thread(load_watchlists)
+        except Exception as e:
+            print(f"Не удалось загрузить списки отслеживания: {e}")
+        try:
+            await asyncio.to_thread(load_catalog)
+        except Exception as e:
+            print(f"Не удалось загрузить каталог товаров: {e}")
+        compaction = asyncio.create_task(compaction_task())
+        api_runner = None
+        try:
+            api_runner = await start_api()
+        except Exception as e:
+            print(f"Не удалось запустить HTTP API: {e}")
+        try:
+            await dp.start_polling(bot)
+        finally:
+            compaction.cancel()
+            if api_runner is not None:
+                await api_runner.cleanup()
+            if catalog_loaded:
+                snapshot_writer.submit(save_catalog, catalog_rows())
+            await asyncio.to_thread(snapshot_writer.close)
     except Exception as e:
         print(f"Критическая ошибка в основном цикле бота: {e}")
 
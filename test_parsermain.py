@@ -1,8 +1,26 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
 import pytest
+from datetime import datetime
+from urllib.parse import quote
+
+from aiohttp.test_utils import TestClient, TestServer
 
 from unittest.mock import patch, Mock
 from parsermain import the_cheapest, sorted_data, save_to_csv
-from unittest.mock import mock_open, patch, Mock
+from parsermain import compact_snapshots, read_history_segment, show_article_price
+from parsermain import SnapshotWriter, save_snapshot, load_snapshot, snapshot_cache
+from parsermain import category_key, snapshot_path, list_snapshots, next_counter, parse_categories, article_history
+from parsermain import update_catalog, expand_rows, product_catalog, load_catalog, compact_catalog
+from parsermain import create_api_app, query_cache, cached_query, invalidate_queries
+from parsermain import ScrapeCache, main_parser, normalize_category, create_driver, resolve_chromedriver
+from parsermain import add_to_watchlist, remove_from_watchlist, check_watchlists, watchlists, article_watchers
+from parsermain import parsing_analysis, watch_alerts, watchlist_rows, save_watchlists, load_watchlists
+from unittest.mock import mock_open, patch, Mock, AsyncMock
 
 class TestTheCheapest:
     def test_find_cheapest_product(self):
@@ -94,7 +112,7 @@ class TestSaveToCSV:
             [456, 2000, "Ноутбук", "4.8"]
         ]
         
-        with patch('builtins.open', mock_open()) as mock_file:
+        with patch('builtins.open', mock_open()) as mock_file, patch('os.replace') as mock_replace:
             with patch('csv.writer') as mock_writer_class:
                 with patch('datetime.datetime') as mock_datetime:
                     
@@ -104,7 +122,8 @@ class TestSaveToCSV:
 
                     save_to_csv(test_data, 1, 777) 
                     assert mock_file.called
-                    assert mock_file.call_args[0][0] == 'elements_777_1.csv'
+                    assert mock_file.call_args[0][0] == 'elements_777_1.csv.tmp'
+                    mock_replace.assert_called_once_with('elements_777_1.csv.tmp', 'elements_777_1.csv')
                     assert mock_writer.writerow.call_count == 3 
 
     def test_save_csv_error_mock(self):
@@ -115,4 +134,607 @@ class TestSaveToCSV:
                 save_to_csv(test_data, 3, 999)
                 assert False
             except PermissionError:
-                assert True
\ No newline at end of file
+                assert True
+
+class TestWatchlists:
+    def setup_method(self):
+        watchlists.clear()
+        article_watchers.clear()
+        watch_alerts.clear()
+
+    def test_drop_rule(self):
+        add_to_watchlist(1, "111")
+        alerts = check_watchlists([("111", 5000, 4500), ("222", 3000, 2000)])
+        assert len(alerts) == 1
+        assert alerts[0][0] == 1
+
+    def test_drop_rule_ignores_price_increase(self):
+        add_to_watchlist(1, "111")
+        assert check_watchlists([("111", 5000, 5500)]) == []
+
+    def test_target_price_crossing(self):
+        add_to_watchlist(1, "111", 4000)
+        add_to_watchlist(2, "111", 3000)
+        alerts = check_watchlists([("111", 5000, 3900)])
+        assert [user_id for user_id, _ in alerts] == [1]
+        assert check_watchlists([("111", 3900, 3800)]) == []
+
+    def test_target_price_new_item(self):
+        add_to_watchlist(1, "333", 4000)
+        alerts = check_watchlists([("333", None, 3500)])
+        assert len(alerts) == 1
+
+    def test_same_change_alerted_once(self):
+        add_to_watchlist(1, "111")
+        assert len(check_watchlists([("111", 5000, 4500)])) == 1
+        assert check_watchlists([("111", 5000, 4500)]) == []
+        assert len(check_watchlists([("111", 4500, 4000)])) == 1
+        check_watchlists([("111", 4000, 5000)])
+        assert len(check_watchlists([("111", 5000, 4000)])) == 1
+
+    def test_persistence(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        add_to_watchlist(1, "111")
+        add_to_watchlist(2, "111", 3000)
+        save_watchlists(watchlist_rows())
+        watchlists.clear()
+        article_watchers.clear()
+        load_watchlists()
+        assert watchlists == {1: {"111": None}, 2: {"111": 3000}}
+        assert article_watchers == {"111": {1: None, 2: 3000}}
+
+    def analyse(self, tmp_path, monkeypatch, old, new):
+        monkeypatch.chdir(tmp_path)
+        snapshot_cache.clear()
+        save_to_csv([[article, price, f"Товар {article}", "4.5"] for article, price in old], 0, 20)
+        save_to_csv([[article, price, f"Товар {article}", "4.5"] for article, price in new], 1, 20)
+        bot = Mock()
+        bot.send_message = AsyncMock()
+        asyncio.run(parsing_analysis(1, bot, 20))
+        return [call.kwargs['text'] for call in bot.send_message.call_args_list if call.kwargs['chat_id'] == 1]
+
+    def test_analysis_alerts_after_removed_rows(self, tmp_path, monkeypatch):
+        add_to_watchlist(1, "500")
+        alerts = self.analyse(tmp_path, monkeypatch,
+                              [(100, 10), (200, 20), (300, 30), (400, 40), (500, 50)],
+                              [(100, 10), (400, 40), (500, 45)])
+        assert len(alerts) == 1
+        assert "500" in alerts[0]
+
+    def test_analysis_alerts_after_new_row(self, tmp_path, monkeypatch):
+        add_to_watchlist(1, "300")
+        alerts = self.analyse(tmp_path, monkeypatch,
+                              [(100, 10), (200, 20), (300, 30)],
+                              [(100, 10), (200, 20), (250, 25), (300, 20)])
+        assert len(alerts) == 1
+        assert "300" in alerts[0]
+
+    def test_remove_updates_index(self):
+        add_to_watchlist(1, "111")
+        assert remove_from_watchlist(1, "111")
+        assert not remove_from_watchlist(1, "111")
+        assert "111" not in article_watchers
+        assert 1 not in watchlists
+
+class TestCompaction:
+    def write_snapshot(self, user_id, counter, rows, timestamp):
+        with open(f'elements_{user_id}_{counter}.csv', 'w', newline='', encoding='utf-8') as f:
+            for row in rows + [[timestamp]]:
+                f.write(','.join(str(x) for x in row) + '\n')
+
+    def test_keeps_recent_and_downsamples_old(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        self.write_snapshot(5, 0, [[111, 5000, "A", "4.5"], [222, 3000, "B", "4.7"]], "01.01.2024 12:00:00")
+        self.write_snapshot(5, 1, [[111, 4000, "A", "4.5"], [222, 3000, "B", "4.7"]], "01.01.2024 12:30:00")
+        self.write_snapshot(5, 2, [[111, 4000, "A", "4.5"], [222, 2500, "B", "4.7"]], "01.01.2024 13:00:00")
+        self.write_snapshot(5, 3, [[111, 3500, "A", "4.5"]], "01.01.2024 14:00:00")
+
+        removed = compact_snapshots(5, keep_recent=1)
+
+        assert removed == 3
+        assert sorted(p.name for p in tmp_path.glob('elements_*')) == ['elements_5_3.csv']
+        assert read_history_segment(5) == [
+            ["01.01.2024 12:30:00", "111", "4000"],
+            ["01.01.2024 12:30:00", "222", "3000"],
+            ["01.01.2024 13:00:00", "222", "2500"],
+        ]
+
+    def test_history_reads_segment_and_recent(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        self.write_snapshot(6, 0, [[111, 5000, "A", "4.5"]], "01.01.2024 12:00:00")
+        self.write_snapshot(6, 1, [[111, 4000, "A", "4.5"]], "02.01.2024 12:00:00")
+        compact_snapshots(6, keep_recent=1)
+
+        text = asyncio.run(show_article_price("111", 6))
+
+        assert "5000" in text
+        assert "4000" in text
+
+    def test_truncated_segment(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        for counter in range(21):
+            self.write_snapshot(5, counter, [[111, 5000 + counter, "A", "4.5"]], f"01.01.2024 {counter:02d}:00:00")
+        compact_snapshots(5, keep_recent=1)
+        segment = tmp_path / 'history_5.2024-01.csv.gz'
+        segment.write_bytes(segment.read_bytes()[:-10])
+
+        recovered = read_history_segment(5)
+        assert 0 < len(recovered) < 20
+        self.write_snapshot(5, 40, [[111, 1, "A", "4.5"]], "01.02.2024 12:00:00")
+        self.write_snapshot(5, 41, [[111, 2, "A", "4.5"]], "02.02.2024 12:00:00")
+        assert compact_snapshots(5, keep_recent=1) == 2
+        assert not (tmp_path / 'history_5.2024-01.csv.gz.tmp').exists()
+        assert read_history_segment(5) == recovered + [["01.01.2024 20:00:00", "111", "5020"],
+                                                       ["01.02.2024 12:00:00", "111", "1"]]
+        assert "1 руб." in asyncio.run(show_article_price("111", 5))
+
+    def test_stale_tmp_segment_is_overwritten(self, tmp_path, monkeypatch):
+        import gzip
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'history_5.2024-01.csv.gz.tmp').write_bytes(gzip.compress(b"01.01.2023 00:00:00,1,1\n" * 100)[:40])
+        for counter in range(4):
+            self.write_snapshot(5, counter, [[111, 5000 + counter, "A", "4.5"]], f"01.01.2024 1{counter}:00:00")
+
+        assert compact_snapshots(5, keep_recent=1) == 3
+        assert [row[2] for row in read_history_segment(5)] == ["5000", "5001", "5002"]
+        assert not (tmp_path / 'history_5.2024-01.csv.gz.tmp').exists()
+
+    def test_nothing_to_compact(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        self.write_snapshot(7, 0, [[111, 5000, "A", "4.5"]], "01.01.2024 12:00:00")
+        assert compact_snapshots(7, keep_recent=2) == 0
+        assert not list(tmp_path.glob('history_7*'))
+
+    def test_monthly_segments_and_state(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        self.write_snapshot(5, 0, [[111, 5000, "A", "4.5"], [222, 3000, "B", "4.7"]], "31.01.2024 12:00:00")
+        self.write_snapshot(5, 1, [[111, 4000, "A", "4.5"]], "01.02.2024 12:00:00")
+        self.write_snapshot(5, 2, [[111, 4000, "A", "4.5"]], "02.02.2024 12:00:00")
+        compact_snapshots(5, keep_recent=1)
+
+        assert sorted(p.name for p in tmp_path.glob('history_*')) == [
+            'history_5.2024-01.csv.gz', 'history_5.2024-02.csv.gz', 'history_5.state.csv']
+        history = [["31.01.2024 12:00:00", "111", "5000"],
+                   ["31.01.2024 12:00:00", "222", "3000"],
+                   ["01.02.2024 12:00:00", "111", "4000"]]
+        assert read_history_segment(5) == history
+        # Февральский сегмент начинается с последних цен января
+        (tmp_path / 'history_5.2024-01.csv.gz').unlink()
+        assert read_history_segment(5) == history
+        assert (tmp_path / 'history_5.state.csv').read_text(encoding='utf-8').splitlines() == [
+            "111,4000,01.02.2024 12:00:00", "222,3000,31.01.2024 12:00:00"]
+
+    def test_old_months_are_downsampled_daily(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        prices = [5000, 4900, 4800, 4800, 4700]
+        for counter, (price, hour) in enumerate(zip(prices, (10, 11, 12, 10, 11))):
+            day = "01" if counter < 3 else "02"
+            self.write_snapshot(5, counter, [[111, price, "A", "4.5"]], f"{day}.01.2024 {hour}:00:00")
+        self.write_snapshot(5, 5, [[111, 4000, "A", "4.5"]], "01.06.2024 12:00:00")
+
+        compact_snapshots(5, keep_recent=1)
+
+        assert sorted(p.name for p in tmp_path.glob('history_*.gz')) == ['history_5.2024-01.daily.csv.gz']
+        assert read_history_segment(5) == [["01.01.2024 12:00:00", "111", "4800"],
+                                           ["02.01.2024 11:00:00", "111", "4700"]]
+
+    def test_legacy_segment_is_migrated(self, tmp_path, monkeypatch):
+        import gzip
+        monkeypatch.chdir(tmp_path)
+        with gzip.open(tmp_path / 'history_5.csv.gz', 'wt', encoding='utf-8') as f:
+            f.write("01.01.2024 12:00:00,111,5000\r\n01.02.2024 12:00:00,111,4500\r\n")
+        self.write_snapshot(5, 0, [[111, 4000, "A", "4.5"]], "01.03.2024 12:00:00")
+        self.write_snapshot(5, 1, [[111, 4000, "A", "4.5"]], "02.03.2024 12:00:00")
+
+        compact_snapshots(5, keep_recent=1)
+
+        assert not (tmp_path / 'history_5.csv.gz').exists()
+        assert [row[2] for row in read_history_segment(5)] == ["5000", "4500", "4000"]
+        assert len(list(tmp_path.glob('history_5.2024-0*.csv.gz'))) == 3
+
+class TestScrapeCache:
+    def test_normalize_category(self):
+        assert normalize_category("  Смартфоны   Apple ") == "смартфоны apple"
+
+    def test_ttl_expiry(self):
+        cache = ScrapeCache(ttl_seconds=60, max_bytes=10**6)
+        with patch('parsermain.time.time', return_value=1000):
+            cache.set(("телефон", 1, "popular"), {"rows": [[1, 100, "A", "5"]], "last": True})
+        with patch('parsermain.time.time', return_value=1030):
+            assert cache.get(("телефон", 1, "popular")) is not None
+            assert cache.get(("телефон", 1, "popular"), max_age_seconds=10) is None
+        with patch('parsermain.time.time', return_value=1100):
+            assert cache.get(("телефон", 1, "popular")) is None
+        assert cache.size == 0
+
+    def test_lru_eviction_by_size(self):
+        cache = ScrapeCache(ttl_seconds=60, max_bytes=200)
+        value = {"rows": [[1, 100, "A", "5"]], "last": False}
+        cache.set(("a", 1, "popular"), value)
+        cache.set(("a", 2, "popular"), value)
+        cache.get(("a", 1, "popular"))
+        cache.set(("a", 3, "popular"), value)
+        assert cache.get(("a", 2, "popular")) is None
+        assert cache.get(("a", 1, "popular")) == value
+        assert cache.size <= 200
+
+    def test_disk_tier(self, tmp_path):
+        value = {"rows": [[1, 100, "A", "5"]], "last": True}
+        asyncio.run(ScrapeCache(60, 10**6, str(tmp_path)).store(("a", 1, "popular"), value))
+        restarted = ScrapeCache(60, 10**6, str(tmp_path))
+        assert restarted.get(("a", 1, "popular")) is None
+        assert asyncio.run(restarted.fetch(("a", 1, "popular"))) == value
+        assert restarted.get(("a", 1, "popular")) == value
+        with patch('parsermain.time.time', return_value=time.time() + 120):
+            assert restarted.purge_expired() == 1
+            assert restarted.size == 0
+            assert len(list(tmp_path.iterdir())) == 1
+            assert restarted.purge_disk() == 1
+        assert list(tmp_path.iterdir()) == []
+
+    def test_broken_disk_record_is_a_miss(self, tmp_path):
+        cache = ScrapeCache(60, 10**6, str(tmp_path))
+        with open(cache._disk_path(("a", 1, "popular")), 'w', encoding='utf-8') as f:
+            f.write('{"value": []}')
+        os.mkdir(cache._disk_path(("a", 2, "popular")))
+        assert asyncio.run(cache.fetch(("a", 1, "popular"))) is None
+        assert asyncio.run(cache.fetch(("a", 2, "popular"))) is None
+
+    @pytest.mark.parametrize("page", [([], True), ([[1, 100, "A", "5"]], False)])
+    def test_empty_or_interrupted_page_not_cached(self, page):
+        session = Mock()
+        session.get_driver = AsyncMock(return_value=Mock(find_elements=Mock(return_value=[])))
+        cache = ScrapeCache(60, 10**6)
+        with patch('parsermain.scrape_cache', cache), \
+                patch('parsermain.open_search', AsyncMock(return_value="https://example.test/search")), \
+                patch('parsermain.scrape_page', AsyncMock(return_value=page)), \
+                patch('parsermain.asyncio.sleep', AsyncMock()):
+            assert asyncio.run(main_parser("телефон", session=session)) == page[0]
+        assert cache.get(("телефон", 1, "popular")) is None
+
+class TestCreateDriver:
+    def test_lean_profile(self):
+        with patch('selenium.webdriver.Chrome') as mock_chrome, patch('parsermain.resolve_chromedriver', return_value='/usr/bin/chromedriver'):
+            driver = create_driver(lean=True, blocked_patterns=['*.png'])
+            options = mock_chrome.call_args.kwargs['options']
+            assert '--headless=new' in options.arguments
+            assert '--disable-gpu' in options.arguments
+            driver.execute_cdp_cmd.assert_any_call('Network.setBlockedURLs', {'urls': ['*.png']})
+
+    def test_full_profile(self):
+        with patch('selenium.webdriver.Chrome') as mock_chrome, patch('parsermain.resolve_chromedriver', return_value='/usr/bin/chromedriver'):
+            driver = create_driver(lean=False)
+            options = mock_chrome.call_args.kwargs['options']
+            assert '--headless=new' not in options.arguments
+            driver.execute_cdp_cmd.assert_not_called()
+
+class TestSnapshotPersistence:
+    def test_failed_write_keeps_previous_file(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        save_to_csv([[111, 5000, "A", "4.5"]], 0, 8)
+        original = (tmp_path / 'elements_8_0.csv').read_text(encoding='utf-8')
+        with patch('csv.writer') as mock_writer_class:
+            mock_writer_class.return_value.writerow.side_effect = OSError("Диск заполнен")
+            with pytest.raises(OSError):
+                save_to_csv([[111, 4000, "A", "4.5"]], 0, 8)
+        assert (tmp_path / 'elements_8_0.csv').read_text(encoding='utf-8') == original
+
+    def test_writer_runs_jobs_in_order(self):
+        writer = SnapshotWriter('batch')
+        calls = []
+        futures = [writer.submit(lambda i, fsync: calls.append((i, fsync)) or i, i) for i in range(5)]
+        assert [future.result(timeout=5) for future in futures] == [0, 1, 2, 3, 4]
+        assert calls == [(i, True) for i in range(5)]
+        writer.close()
+
+    def test_writer_reports_errors(self):
+        writer = SnapshotWriter()
+        def fail(fsync):
+            raise PermissionError("Нет прав на запись")
+        with pytest.raises(PermissionError):
+            writer.submit(fail).result(timeout=5)
+        writer.close()
+
+    def test_unknown_fsync_policy(self):
+        with pytest.raises(ValueError):
+            SnapshotWriter('sometimes')
+
+    def test_save_and_load_snapshot(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        snapshot_cache.clear()
+        asyncio.run(save_snapshot([[111, 5000, "A", "4.5"]], 0, 9))
+
+        rows = asyncio.run(load_snapshot(9, 0))
+        assert rows[0] == ["111", "5000", "A", "4.5"]
+        snapshot_cache.clear()
+        assert asyncio.run(load_snapshot(9, 0)) == rows
+        with pytest.raises(FileNotFoundError):
+            asyncio.run(load_snapshot(9, 1))
+
+class TestColdStart:
+    def test_import_does_not_load_scraper(self):
+        code = "import sys, parsermain; print('selenium' in sys.modules or 'webdriver_manager' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert result.stdout.strip() == "False"
+
+    def test_pinned_driver_path(self, tmp_path):
+        driver_file = tmp_path / "chromedriver"
+        driver_file.write_text("")
+        with patch('parsermain.CHROMEDRIVER_PATH', str(driver_file)), patch('parsermain.chromedriver_path', None):
+            with patch('webdriver_manager.chrome.ChromeDriverManager') as mock_manager:
+                assert resolve_chromedriver() == str(driver_file)
+                mock_manager.assert_not_called()
+
+    def test_missing_pinned_driver_path(self, tmp_path):
+        with patch('parsermain.CHROMEDRIVER_PATH', str(tmp_path / "missing")), patch('parsermain.chromedriver_path', None):
+            with pytest.raises(FileNotFoundError):
+                resolve_chromedriver()
+
+    def test_resolved_once(self):
+        with patch('parsermain.CHROMEDRIVER_PATH', None), patch('parsermain.chromedriver_path', None):
+            with patch('webdriver_manager.chrome.ChromeDriverManager') as mock_manager:
+                mock_manager.return_value.install.return_value = '/cache/chromedriver'
+                assert resolve_chromedriver() == '/cache/chromedriver'
+                assert resolve_chromedriver() == '/cache/chromedriver'
+                assert mock_manager.return_value.install.call_count == 1
+
+class TestMultiCategory:
+    def test_category_key(self):
+        assert category_key("  Чехлы_для  iPhone ") == "чехлы-для-iphone"
+        assert category_key(category_key("Чехлы для iPhone")) == "чехлы-для-iphone"
+
+    def test_snapshot_paths(self):
+        assert snapshot_path(5, 3) == 'elements_5_3.csv'
+        assert snapshot_path(5, 3, "Смартфоны") == 'elements_5_смартфоны_3.csv'
+
+    def test_snapshots_are_kept_per_category(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        save_to_csv([[111, 5000, "A", "4.5"]], 0, 5, "Телефоны")
+        save_to_csv([[111, 4900, "A", "4.5"]], 1, 5, "Телефоны")
+        save_to_csv([[222, 300, "B", "4.0"]], 0, 5, "Чехлы")
+        save_to_csv([[333, 100, "C", "4.0"]], 0, 5)
+
+        assert list_snapshots(5, "телефоны") == ['elements_5_телефоны_0.csv', 'elements_5_телефоны_1.csv']
+        assert list_snapshots(5) == ['elements_5_0.csv']
+        assert next_counter(5, "Телефоны") == 2
+        assert next_counter(5, "Чехлы") == 1
+        assert [price for _, price in article_history("111", 5)] == [5000, 4900]
+        assert [price for _, price in article_history("222", 5)] == [300]
+        assert article_history("111", 6) is None
+
+    def test_categories_share_one_session(self):
+        sessions = []
+
+        async def fake_parser(category, max_age_seconds=None, session=None):
+            sessions.append(session)
+            if category == "сломанная":
+                raise RuntimeError("Ошибка страницы")
+            return [[111, 5000, category, "4.5"]]
+
+        with patch('parsermain.main_parser', side_effect=fake_parser):
+            results = asyncio.run(parse_categories(["телефоны", "сломанная", "чехлы"]))
+
+        assert len(sessions) == 3
+        assert sessions[0] is sessions[1] is sessions[2]
+        assert results["телефоны"] == [[111, 5000, "телефоны", "4.5"]]
+        assert isinstance(results["сломанная"], RuntimeError)
+
+    def test_categories_stay_batched_across_cycles(self):
+        import parsermain
+        clock = [0.0]
+        batches = []
+
+        async def fake_parse(due, max_age_seconds=None):
+            batches.append(list(due))
+            if len(batches) == 4:
+                raise asyncio.CancelledError()
+            return {category: [] for category in due}
+
+        async def fake_process(*args):
+            clock[0] += 0.5
+            return True
+
+        async def fake_wait_for(awaitable, timeout):
+            awaitable.close()
+            clock[0] += timeout
+            raise asyncio.TimeoutError()
+
+        parsermain.subscriptions[21] = {'a': 1, 'b': 1, 'c': 1}
+        try:
+            with patch('parsermain.time', Mock(monotonic=lambda: clock[0])), \
+                    patch('parsermain.parse_categories', side_effect=fake_parse), \
+                    patch('parsermain.process_category', side_effect=fake_process), \
+                    patch('parsermain.next_counter', return_value=0), \
+                    patch('parsermain.asyncio.wait_for', side_effect=fake_wait_for):
+                asyncio.run(parsermain.start_parsing_task(21, AsyncMock()))
+        finally:
+            parsermain.subscriptions.pop(21, None)
+            parsermain.subscription_events.pop(21, None)
+        assert batches == [['a', 'b', 'c']] * 4
+
+class TestCatalog:
+    def setup_method(self):
+        product_catalog.clear()
+
+    def test_update_only_on_change(self):
+        data = [[111, 5000, "Товар A", "4.5"], [222, 3000, "Товар B", "4.7"]]
+        assert update_catalog(data, "01.01.2024 12:00:00")
+        assert not update_catalog(data, "01.01.2024 13:00:00")
+        assert product_catalog["111"] == ["Товар A", "4.5", "01.01.2024 12:00:00", "01.01.2024 13:00:00"]
+        assert update_catalog([[111, 4000, "Товар A", "4.6"]], "01.01.2024 14:00:00")
+        assert product_catalog["111"][1] == "4.6"
+
+    def test_names_are_interned(self):
+        update_catalog([[111, 5000, "".join(["Товар", " A"]), "4.5"]], "01.01.2024 12:00:00")
+        update_catalog([[222, 3000, "".join(["Товар", " A"]), "4.5"]], "01.01.2024 12:00:00")
+        assert product_catalog["111"][0] is product_catalog["222"][0]
+
+    def test_expand_rows(self):
+        update_catalog([[111, 5000, "Товар A", "4.5"]], "01.01.2024 12:00:00")
+        rows = expand_rows([["111", "4000"], ["999", "100"], ["333", "10", "Старый", "4.0"], ["01.01.2024 13:00:00"]])
+        assert rows == [["111", "4000", "Товар A", "4.5"], ["999", "100", "", "0"],
+                        ["333", "10", "Старый", "4.0"], ["01.01.2024 13:00:00"]]
+
+    def test_snapshot_stores_only_prices(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        snapshot_cache.clear()
+        with patch('parsermain.catalog_loaded', True):
+            asyncio.run(save_snapshot([[111, 5000, "Товар A", "4.5"]], 0, 10))
+        assert (tmp_path / 'elements_10_0.csv').read_text(encoding='utf-8').splitlines()[0] == "111,5000"
+        assert "Товар A" in (tmp_path / 'catalog_log.csv').read_text(encoding='utf-8')
+        snapshot_cache.clear()
+        assert asyncio.run(load_snapshot(10, 0))[0] == ["111", "5000", "Товар A", "4.5"]
+
+    def test_log_appends_changes_and_compacts(self, tmp_path, monkeypatch):
+        import parsermain
+        monkeypatch.chdir(tmp_path)
+        snapshot_cache.clear()
+        writer = SnapshotWriter('none')
+        with patch('parsermain.snapshot_writer', writer), patch('parsermain.catalog_loaded', True), \
+                patch('parsermain.catalog_log_size', 0):
+            asyncio.run(save_snapshot([[111, 5000, "Товар A", "4.5"], [222, 3000, "Товар B", "4.7"]], 0, 10))
+            asyncio.run(save_snapshot([[111, 4000, "Товар A", "4.6"], [222, 2900, "Товар B", "4.7"]], 1, 10))
+            log = (tmp_path / 'catalog_log.csv').read_text(encoding='utf-8').splitlines()
+            assert [line.split(',')[:3] for line in log] == [
+                ["111", "Товар A", "4.5"], ["222", "Товар B", "4.7"], ["111", "Товар A", "4.6"]]
+            assert not (tmp_path / 'catalog.csv').exists()
+
+            product_catalog.clear()
+            parsermain.catalog_loaded = False
+            load_catalog()
+            assert product_catalog["111"][:2] == ["Товар A", "4.6"]
+
+            compact_catalog().result()
+            assert not (tmp_path / 'catalog_log.csv').exists()
+            assert len((tmp_path / 'catalog.csv').read_text(encoding='utf-8').splitlines()) == 2
+            assert compact_catalog() is None
+        writer.close()
+
+    def test_concurrent_load_reads_once(self):
+        import threading
+
+        def slow_read(path):
+            time.sleep(0.05)
+            raise FileNotFoundError(path)
+
+        with patch('parsermain.catalog_loaded', False), patch('parsermain.read_csv_rows', side_effect=slow_read) as read:
+            threads = [threading.Thread(target=load_catalog) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert read.call_count == 2
+
+class TestQueryAPI:
+    def prepare(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        snapshot_cache.clear()
+        query_cache.clear()
+        product_catalog.clear()
+        with patch('parsermain.datetime') as mock_datetime:
+            mock_datetime.now.return_value.strftime.return_value = "01.01.2024 12:00:00"
+            asyncio.run(save_snapshot([[111, 5000, "A", "4.5"], [222, 3000, "B", "4.7"]], 0, 11, "Телефоны"))
+            mock_datetime.now.return_value.strftime.return_value = "01.01.2024 13:00:00"
+            asyncio.run(save_snapshot([[111, 4500, "A", "4.5"], [333, 100, "C", "4.0"]], 1, 11, "Телефоны"))
+
+    def request(self, *paths):
+        async def run():
+            async with TestClient(TestServer(create_api_app())) as client:
+                results = []
+                for path in paths:
+                    response = await client.get(path)
+                    body = await response.text()
+                    results.append((response.status, body))
+                return results
+        return asyncio.run(run())
+
+    def test_latest_with_pagination(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        (status, body), = self.request('/users/11/categories/Телефоны/latest?limit=1&offset=1')
+        data = json.loads(body)
+        assert status == 200
+        assert data['total'] == 2
+        assert data['timestamp'] == "01.01.2024 13:00:00"
+        assert data['items'] == [{'article': '333', 'price': 100, 'name': 'C', 'rating': '4.0'}]
+
+    def test_cheapest_and_streaming(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        (status, body), (_, streamed) = self.request(
+            '/users/11/categories/телефоны/cheapest?n=1',
+            '/users/11/categories/телефоны/latest?stream=1')
+        assert status == 200
+        assert [item['article'] for item in json.loads(body)['items']] == ['333']
+        assert [json.loads(line)['article'] for line in streamed.splitlines()] == ['111', '333']
+
+    def test_diff_and_history(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        (status, body), (_, history) = self.request(
+            '/users/11/categories/телефоны/diff?from=2024-01-01T12:30:00',
+            '/users/11/articles/111/history')
+        items = json.loads(body)['items']
+        assert status == 200
+        assert {(item['type'], item['article']) for item in items} == {('price', '111'), ('new', '333'), ('removed', '222')}
+        assert [point['price'] for point in json.loads(history)['items']] == [5000, 4500]
+
+    def test_errors(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        (missing, _), (bad, _) = self.request(
+            '/users/12/categories/телефоны/latest',
+            '/users/11/categories/телефоны/diff?from=вчера')
+        assert missing == 404
+        assert bad == 400
+
+    def test_cache_invalidated_on_save(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        self.request('/users/11/categories/телефоны/latest')
+        assert query_cache
+        asyncio.run(save_snapshot([[111, 4000, "A", "4.5"]], 2, 11, "Телефоны"))
+        assert not query_cache
+
+    def test_invalid_paging(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        responses = self.request(
+            '/users/11/categories/телефоны/latest?limit=0',
+            '/users/11/categories/телефоны/latest?limit=-1',
+            '/users/11/categories/телефоны/latest?limit=-1&stream=1',
+            '/users/11/categories/телефоны/latest?offset=-1')
+        assert [status for status, _ in responses] == [400, 400, 400, 400]
+
+    def test_diff_with_timezone(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        moment = quote(datetime(2024, 1, 1, 12, 30).astimezone().isoformat())
+        (status, body), = self.request(f'/users/11/categories/телефоны/diff?from={moment}')
+        assert status == 200
+        assert json.loads(body)['from'] == "01.01.2024 12:00:00"
+
+    def test_diff_from_history_segment(self, tmp_path, monkeypatch):
+        self.prepare(tmp_path, monkeypatch)
+        compact_snapshots(11, 1, "Телефоны")
+        (status, body), = self.request('/users/11/categories/телефоны/diff?from=2024-01-01T12:30:00')
+        data = json.loads(body)
+        assert status == 200
+        assert data['from'] == "01.01.2024 12:00:00"
+        assert {(item['type'], item['article']) for item in data['items']} == {('price', '111'), ('new', '333'), ('removed', '222')}
+
+    def test_stale_result_not_cached(self):
+        query_cache.clear()
+
+        def compute():
+            invalidate_queries('11')
+            return 'stale'
+
+        assert asyncio.run(cached_query(('11', 'latest', 'key'), compute)) == 'stale'
+        assert ('11', 'latest', 'key') not in query_cache
+
+    def test_main_survives_busy_port(self, tmp_path, monkeypatch):
+        import parsermain
+        monkeypatch.chdir(tmp_path)
+        polling = AsyncMock()
+        with patch('parsermain.start_api', AsyncMock(side_effect=OSError("address in use"))), \
+                patch('parsermain.Dispatcher.start_polling', polling), \
+                patch('parsermain.resolve_chromedriver'), \
+                patch('parsermain.compaction_task', AsyncMock()), \
+                patch('parsermain.snapshot_writer', SnapshotWriter('none')):
+            asyncio.run(parsermain.main())
+        polling.assert_awaited_once()